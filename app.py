@@ -6,10 +6,13 @@
 #                                                               #
 #################################################################
 
-from flask import Flask, redirect, request, url_for
+from flask import Flask, jsonify, make_response, redirect, request, url_for
 from remote_setup import homeScreen, promptPlayerCode, remoteSetup
-from game_store import GameNotFound, GameStoreError, GameVersionConflict, load_game
+from game_store import GameNotFound, GameStoreError, GameVersionConflict, apply_move, load_game, \
+	load_version, wait_for_version
 from turnstile import Turnstile
+import hashlib
+import os
 import requests
 
 # Initiate flask program
@@ -88,8 +91,14 @@ def handle_form_submission():
 			player_code = int(player_code_str)
 		except ValueError:
 			return "Invalid game or player code.", 400
-		game = load_game(game_code)
-		return game.chess_page(player_code)
+		# The version of the game the page was showing, if it says
+		version_str = request.form.get("version")
+		try:
+			expected_version = int(version_str) if version_str else None
+		except ValueError:
+			return "Invalid game version.", 400
+		game, view = apply_move(game_code, expected_version, lambda game: game.take_turn(player_code))
+		return game.render_page(view)
 
 	elif formtype == "join_verify":
 		game_code_str = request.form.get("game_code")
@@ -112,6 +121,28 @@ def handle_form_submission():
 	else:
 		return "Unknown form type.", 400
 
+# Changes whenever the code that draws the game page does, so a browser does
+# not keep a page (and its script) from before a deploy.  Set APP_VERSION to
+# name the build instead
+def page_build() -> str:
+	version = os.environ.get("APP_VERSION")
+	if version:
+		return version
+	digest = hashlib.sha256()
+	for module in ("game.py", "board.py", "pieces.py"):
+		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), "rb") as source:
+			digest.update(source.read())
+	return digest.hexdigest()[:16]
+
+PAGE_BUILD = page_build()
+
+# Entity tag for a player's game page.  A page fetched with GET shows nothing
+# that is not saved with the game (errors only come back from a POST, which is
+# never cached), so the build, game code, version and player are enough to
+# tell whether the page has changed
+def page_etag(game_code: int, version: int, player_code: int) -> str:
+	return hashlib.sha256(f"{PAGE_BUILD}:{game_code}:{version}:{player_code}".encode()).hexdigest()[:32]
+
 @app.route("/", methods=["GET", "POST"])
 def gameplay():
 	if request.method == "POST":
@@ -121,23 +152,164 @@ def gameplay():
 		player_code = request.args.get("player")
 		if ((game_code is not None) and (player_code is not None)):
 			try:
-				game = load_game(int(game_code))
-				return game.chess_page(int(player_code))
+				game_code = int(game_code)
+				player_code = int(player_code)
 			except ValueError:
 				return "Invalid game or player code.", 400
+			# Check a browser's copy against the version alone, before the game
+			# is loaded or drawn (and only when it has a copy to check)
+			response = None
+			if request.if_none_match:
+				etag = page_etag(game_code, load_version(game_code), player_code)
+				if request.if_none_match.contains(etag):
+					response = make_response("", 304)
+			if response is None:
+				game = load_game(game_code)
+				response = make_response(game.chess_page(player_code))
+				# Tagged with the version the page was drawn from, since a move
+				# may have been saved after the version was looked up
+				etag = page_etag(game_code, game.version, player_code)
+			response.set_etag(etag)
+			# Kept by the browser only, and checked with the server every time
+			response.headers["Cache-Control"] = "private, no-cache"
+			return response
 	return homeScreen()
 
+# Longest a request to /version may be held open waiting for a move
+LONG_POLL_TIMEOUT = float(os.environ.get("LONG_POLL_TIMEOUT", "25"))
+
+# The saved version of a game.  A waiting player's page passes the version it
+# was drawn at as "since", and the request is held open (long polling) until
+# the opponent saves a newer one, so the page can reload straight away
+@app.route("/version", methods=["GET"])
+def game_version():
+	try:
+		game_code = int(request.args.get("game", ""))
+		since = request.args.get("since")
+		since = int(since) if since is not None else None
+	except ValueError:
+		return "Invalid game code or version.", 400
+	if since is None:
+		version = load_version(game_code)
+	else:
+		version = wait_for_version(game_code, since, LONG_POLL_TIMEOUT)
+	response = jsonify(version=version)
+	response.headers["Cache-Control"] = "no-store"
+	return response
+
+
+# JSON API, for clients that keep the board themselves.  Games are named by
+# "game" and players by "player" (their codes), as in the page's address
+
+# Pieces a pawn can be promoted to, by their value in the page's form
+PROMOTION_CHOICES = {"queen": "1", "bishop": "2", "knight": "3", "rook": "4"}
+
+def api_codes(values) -> tuple:
+	return int(values.get("game") or ""), int(values.get("player") or "")
+
+# The board (in FEN, i.e.: "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR") and
+# status of a game.  A client that passes the version it already has as
+# "since" gets back just the version when nothing has changed
+@app.route("/api/game", methods=["GET"])
+def api_game():
+	try:
+		game_code, player_code = api_codes(request.args)
+		since = request.args.get("since")
+		since = int(since) if since is not None else None
+	except ValueError:
+		return jsonify(error="Invalid game code, player code or version."), 400
+	# An unchanged game comes from the cache without being rebuilt, so the
+	# player can be checked before anything is said about it
+	game = load_game(game_code)
+	player = game.getPlayer(player_code)
+	if player is None:
+		return jsonify(error="Your code does not match either player."), 403
+	if since is not None and game.version == since:
+		return jsonify(version=since, changed={})
+	return jsonify(position=game.chess_game.board.placement(), **game.status(player))
+
+# The moves the player can make, i.e.: ["e2e3", "e2e4", ...], which are only
+# there when it is their turn
+@app.route("/api/moves", methods=["GET"])
+def api_moves():
+	try:
+		game_code, player_code = api_codes(request.args)
+	except ValueError:
+		return jsonify(error="Invalid game or player code."), 400
+	game = load_game(game_code)
+	player = game.getPlayer(player_code)
+	if player is None:
+		return jsonify(error="Your code does not match either player."), 403
+	return jsonify(version=game.version, moves=game.legal_moves(player))
+
+# Make a move, given as {"game", "player", "from", "to"}, or choose what a pawn
+# that reached the far side becomes, given as {"game", "player", "promotion"}
+# (one of PROMOTION_CHOICES).  Passing the "version" the client has makes the
+# move fail if the opponent has moved since.  Only the squares that changed
+# are sent back, along with the new status
+@app.route("/api/move", methods=["POST"])
+def api_move():
+	data = request.get_json(silent=True)
+	if not isinstance(data, dict):
+		return jsonify(error="Expected a JSON object."), 400
+	try:
+		game_code, player_code = api_codes(data)
+		expected_version = int(data["version"]) if data.get("version") is not None else None
+	except (TypeError, ValueError):
+		return jsonify(error="Invalid game code, player code or version."), 400
+	promotion = data.get("promotion")
+	if promotion is not None:
+		if not isinstance(promotion, str) or promotion not in PROMOTION_CHOICES:
+			return jsonify(error="Promotion must be one of " + ", ".join(PROMOTION_CHOICES) + "."), 400
+		form = {"promotion": "1", "promotion_pieces": PROMOTION_CHOICES[promotion]}
+	else:
+		form = {"next_move_start": str(data.get("from", "")), "next_move_end": str(data.get("to", ""))}
+
+	def play(game):
+		played = {"player": game.getPlayer(player_code), "error": "", "before": None}
+		chess = game.chess_game
+		if played["player"] is None:
+			return False, played
+		if played["player"] != chess.currentPlayer:
+			played["error"] = "Not yet your turn, please wait"
+		elif not chess.gameOn:
+			played["error"] = "The game is over"
+		elif game.awaiting_promotion() and promotion is None:
+			played["error"] = "Pick a piece to promote your pawn to first"
+		elif not game.awaiting_promotion() and promotion is not None:
+			played["error"] = "There is no pawn to promote"
+		if played["error"]:
+			return False, played
+		played["before"] = list(chess.board.mailbox)
+		should_save, view = game.take_turn(player_code, form)
+		played["error"] = view["error"]
+		return should_save, played
+
+	game, played = apply_move(game_code, expected_version, play)
+	if played["player"] is None:
+		return jsonify(error="Your code does not match either player."), 403
+	if played["error"]:
+		return jsonify(error=played["error"], **game.status(played["player"])), 422
+	return jsonify(changed=game.changed_squares(played["before"]), **game.status(played["player"]))
+
+
+# Errors are sent as JSON to the API and as text to everything else
+def error_response(message: str, status: int):
+	if request.path.startswith("/api/"):
+		return jsonify(error=message), status
+	return message, status
+
 
 @app.errorhandler(GameNotFound)
 def game_not_found(error):
-	return str(error), 404
+	return error_response(str(error), 404)
 
 
 @app.errorhandler(GameVersionConflict)
 def game_version_conflict(error):
-	return "The game changed in another request. Refresh the page and try again.", 409
+	return error_response("The game changed in another request. Refresh the page and try again.", 409)
 
 
 @app.errorhandler(GameStoreError)
 def game_store_error(error):
-	return str(error), 503
+	return error_response(str(error), 503)
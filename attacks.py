@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Attack tables for every piece on every square, built once at import so that
+# move generation becomes a handful of lookups instead of walking the grid
+
+from bitboard import EMPTY, FULL, bit, indices, shift, slide
+from piecetypes import Bishop, King, Knight, Rook
+
+# Step attacks, indexed by square
+KNIGHT_ATTACKS = [
+    sum(shift(bit(index), vector) for vector in Knight.moves) for index in range(64)
+]
+KING_ATTACKS = [
+    sum(shift(bit(index), vector) for vector in King.moves) for index in range(64)
+]
+
+# Squares a pawn of each player threatens, indexed by square
+PAWN_ATTACKS = {
+    player: [
+        shift(bit(index), (direction, 1)) | shift(bit(index), (direction, -1))
+        for index in range(64)
+    ]
+    for player, direction in ((1, 1), (2, -1))
+}
+
+# Everything from a square to the edge of an empty board, for each direction
+# a bishop or rook can slide in
+RAYS = {
+    vector: [slide(bit(index), vector, FULL) for index in range(64)]
+    for vector in Rook.moves | Bishop.moves
+}
+
+# Rays pointing towards higher square numbers meet their first blocker at the
+# lowest set bit, the rest at the highest
+RISING = {vector: vector[0] * 8 + vector[1] > 0 for vector in RAYS}
+
+STEP_ATTACKS = {"knight": KNIGHT_ATTACKS, "king": KING_ATTACKS}
+
+# Squares strictly between two squares on the same row, column or diagonal
+# (empty when they do not line up), indexed [from][to]
+def betweenTable() -> list:
+    between = [[EMPTY] * 64 for index in range(64)]
+    for rays in RAYS.values():
+        for index in range(64):
+            for other in indices(rays[index]):
+                between[index][other] = rays[index] & ~rays[other] & ~bit(other)
+    return between
+
+
+BETWEEN = betweenTable()
+
+
+# The first occupied square along a ray, given the occupied squares on it
+def firstBlocker(vector: tuple, blockers: int) -> int:
+    if RISING[vector]:
+        return (blockers & -blockers).bit_length() - 1
+    return blockers.bit_length() - 1
+
+
+# Squares reached along each vector until (and including) the first blocker
+def slidingAttacks(index: int, vectors, occupied: int) -> int:
+    attacks = EMPTY
+    for vector in vectors:
+        ray = RAYS[vector][index]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= RAYS[vector][firstBlocker(vector, blockers)]
+        attacks |= ray
+    return attacks
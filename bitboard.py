@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# Bitboard helpers for the board's position core.  Each square on the board is
+# one bit of a 64-bit integer, numbered row * 8 + column, so bit 0 is a1 and
+# bit 63 is h8 (rows and columns use the same 0-7 indexing as Square)
+
+FULL = 0xFFFFFFFFFFFFFFFF
+EMPTY = 0
+
+FILE_A = 0x0101010101010101
+FILE_B = FILE_A << 1
+FILE_G = FILE_A << 6
+FILE_H = FILE_A << 7
+
+# Squares left over after a shift to the east or west, used to stop
+# pieces from wrapping around the edge of the board onto the next row
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+NOT_FILE_AB = FULL ^ (FILE_A | FILE_B)
+NOT_FILE_GH = FULL ^ (FILE_G | FILE_H)
+
+
+# Translate a row and column into a bit index
+def squareIndex(row: int, column: int) -> int:
+    return row * 8 + column
+
+
+# Algebraic name of a square, i.e.: 0 is "a1"
+def squareName(index: int) -> str:
+    return "abcdefgh"[index % 8] + str(index // 8 + 1)
+
+
+# Bit index of an algebraic square name, i.e.: "a1" is 0
+def squareFromName(name: str) -> int:
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
+        raise ValueError("Not a square: " + repr(name))
+    return (int(name[1]) - 1) * 8 + "abcdefgh".index(name[0])
+
+
+# Bitboard with only the given square set
+def bit(index: int) -> int:
+    return 1 << index
+
+
+# Move every piece on a bitboard one step along a (row, column) vector,
+# dropping anything that falls off the board
+def shift(board: int, vector: tuple) -> int:
+    rowStep, columnStep = vector
+    distance = rowStep * 8 + columnStep
+    if distance > 0:
+        board = (board << distance) & FULL
+    else:
+        board >>= -distance
+    if columnStep == 1:
+        board &= NOT_FILE_A
+    elif columnStep == 2:
+        board &= NOT_FILE_AB
+    elif columnStep == -1:
+        board &= NOT_FILE_H
+    elif columnStep == -2:
+        board &= NOT_FILE_GH
+    return board
+
+
+# Walk a bitboard along a vector until it runs into an occupied square or the
+# edge.  The blocking square is included so that captures are covered
+def slide(board: int, vector: tuple, empty: int) -> int:
+    attacks = EMPTY
+    board = shift(board, vector)
+    while board:
+        attacks |= board
+        board = shift(board & empty, vector)
+    return attacks
+
+
+# Yield the index of every set bit, lowest first
+def indices(board: int):
+    while board:
+        lowest = board & -board
+        yield lowest.bit_length() - 1
+        board ^= lowest
+
+
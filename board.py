@@ -6,9 +6,101 @@
 #                                                               #
 #################################################################
 
-from piecetypes import Piece
+from piecetypes import Piece, PIECE_NAMES
 from pieces import *
+from bitboard import FULL, EMPTY, bit, indices, squareIndex, squareName
+from attacks import BETWEEN, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, RAYS, STEP_ATTACKS, \
+    firstBlocker, slidingAttacks
+from zobrist import CASTLING_KEYS, EN_PASSANT_KEYS, PIECE_KEYS, SIDE_KEY
+from lru import LRUCache
 import json
+import os
+
+# Castling rights, as bits of Board.castling
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING = 15
+
+# Rights lost when a piece moves from (or is captured on) a king's or rook's
+# starting square
+CASTLING_LOSS = {
+    4: WHITE_KING_SIDE | WHITE_QUEEN_SIDE, 7: WHITE_KING_SIDE, 0: WHITE_QUEEN_SIDE,
+    60: BLACK_KING_SIDE | BLACK_QUEEN_SIDE, 63: BLACK_KING_SIDE, 56: BLACK_QUEEN_SIDE,
+}
+
+# The king's and rook's starting squares for each castling right
+CASTLING_SQUARES = {
+    WHITE_KING_SIDE: (1, 4, 7), WHITE_QUEEN_SIDE: (1, 4, 0),
+    BLACK_KING_SIDE: (2, 60, 63), BLACK_QUEEN_SIDE: (2, 60, 56),
+}
+
+# Castling rights written the same way as in FEN, i.e.: "KQkq", or "-" for none
+CASTLING_LETTERS = ((WHITE_KING_SIDE, "K"), (WHITE_QUEEN_SIDE, "Q"),
+                    (BLACK_KING_SIDE, "k"), (BLACK_QUEEN_SIDE, "q"))
+
+
+def castlingToText(rights: int) -> str:
+    return "".join(letter for right, letter in CASTLING_LETTERS if rights & right) or "-"
+
+
+def castlingFromText(text: str) -> int:
+    return sum(right for right, letter in CASTLING_LETTERS if letter in text)
+
+
+# Work out castling rights from an 8x8 list of serialized pieces that carry a
+# "moved" flag each (the layout games used to be saved in)
+def legacyCastling(grid: list) -> int:
+    rights = 0
+    for player, row, kingSide, queenSide in ((1, 0, WHITE_KING_SIDE, WHITE_QUEEN_SIDE),
+                                             (2, 7, BLACK_KING_SIDE, BLACK_QUEEN_SIDE)):
+        def unmoved(column, name):
+            piece = grid[row][column]
+            return piece is not None and piece["type"] == name and \
+                piece["player"] == player and not piece.get("moved", True)
+        if unmoved(4, "king"):
+            if unmoved(7, "rook"):
+                rights |= kingSide
+            if unmoved(0, "rook"):
+                rights |= queenSide
+    return rights
+
+
+# HTML for each square of the board with each piece (or None) on it, coloured
+# as the square is
+SQUARE_HTML = tuple(
+    {piece: "<div class=\"" + ("black" if (index // 8 + index % 8) % 2 == 0 else "white") + "\">" +
+            (piece.symbol if piece is not None else "&nbsp;") + "</div>"
+     for piece in (None,) + tuple(PIECES.values())}
+    for index in range(64)
+)
+
+
+# The frame of the board as seen by a player (labels around the edge, with a
+# "{}" for each square), and the squares in the order they fill it
+def boardTemplate(player: int) -> tuple:
+    rows = range(7, -1, -1) if player == 1 else range(8)
+    columns = range(8) if player == 1 else range(7, -1, -1)
+    files = [chr(ord("a") + column) for column in columns]
+    parts = ["<br><div class=\"white\"></div>"]
+    parts += ["<div class=\"white toplabel\">" + file + "</div>" for file in files]
+    parts.append("<br>")
+    for row in rows:
+        parts.append("<div class=\"white leftlabel\">" + str(row + 1) + "</div>")
+        parts.append("{}" * 8)
+        parts.append("<div class=\"white rightlabel\">" + str(row + 1) + "</div><br>")
+    parts.append("<div class=\"white\">&nbsp;</div>")
+    parts += ["<div class=\"white bottomlabel\">" + file + "</div>" for file in files]
+    parts.append("<br><br>")
+    return "".join(parts), tuple(row * 8 + column for row in rows for column in columns)
+
+
+BOARD_TEMPLATES = {1: boardTemplate(1), 2: boardTemplate(2)}
+
+# Boards already drawn, by position hash and player
+boardCache = LRUCache(int(os.environ.get("BOARD_CACHE_SIZE", "1024")))
+
 
 # Yield the opposite player
 def opponent(player):
@@ -21,17 +113,38 @@ def opponent(player):
 
 
 # Class that represents one square on a board (note that indexing
-# in Python is from 0, so translation is required)
+# in Python is from 0, so translation is required).  A square that belongs to
+# a board is only a view of it: the piece itself is kept in the board's mailbox
 class Square(object):
     row: int
     column: int
-    piece: Piece
+    index: int  # bit number of this square on the board's bitboards
+    board: "Board"
 
     # Can be initiated with or without an occupying piece
-    def __init__(self, thisRow, thisColumn, thisPiece=None):
+    def __init__(self, thisRow, thisColumn, thisPiece=None, thisBoard=None):
         self.row = thisRow
         self.column = thisColumn
-        self.piece = thisPiece
+        self.index = squareIndex(thisRow, thisColumn)
+        self.board = thisBoard
+        self._piece = None
+        if thisPiece is not None:
+            self.piece = thisPiece
+
+    # The occupying piece.  Setting it keeps the owning board's bitboards in
+    # step, so pieces can still be moved by assigning to square.piece
+    @property
+    def piece(self) -> Piece:
+        if self.board is not None:
+            return self.board.mailbox[self.index]
+        return self._piece
+
+    @piece.setter
+    def piece(self, piece: Piece):
+        if self.board is not None:
+            self.board.placePiece(self.index, piece)
+        else:
+            self._piece = piece
 
     # Over-riding 'to string' function for displaying on board
     def __str__(self):
@@ -64,31 +177,229 @@ class Square(object):
         return 0 <= row <= 7 and 0 <= column <= 7
 
 
+# A move from one square to another (by bit index), along with the name of
+# the piece a pawn is promoted to, if any
+class Move(object):
+    __slots__ = ("start", "end", "promotion")
+    start: int
+    end: int
+    promotion: str
+
+    def __init__(self, thisStart: int, thisEnd: int, thisPromotion: str = None):
+        self.start = thisStart
+        self.end = thisEnd
+        self.promotion = thisPromotion
+
+    def __eq__(self, other):
+        return isinstance(other, Move) and self.start == other.start and \
+            self.end == other.end and self.promotion == other.promotion
+
+    def __hash__(self):
+        return hash((self.start, self.end, self.promotion))
+
+    # Shown in coordinate notation, i.e.: "e2e4" or "e7e8q"
+    def __str__(self):
+        code = squareName(self.start) + squareName(self.end)
+        if self.promotion is not None:
+            code += "n" if self.promotion == "knight" else self.promotion[0]
+        return code
+
+    __repr__ = __str__
+
+
+# Everything needed to take back a move made with Board.make_move
+class Undo(object):
+    __slots__ = ("move", "piece", "captured", "capturedIndex", "castling", "enPassant", "halfmoveClock")
+    move: Move
+    piece: Piece  # the piece that moved (a pawn, if it was promoted)
+    captured: Piece
+    capturedIndex: int  # differs from move.end only for en passant
+    castling: int  # the board's castling rights before the move
+    enPassant: int  # the board's en passant square before the move
+    halfmoveClock: int  # the board's halfmove clock before the move
+
+    def __init__(self, move, piece, captured, capturedIndex, castling, enPassant, halfmoveClock):
+        self.move = move
+        self.piece = piece
+        self.captured = captured
+        self.capturedIndex = capturedIndex
+        self.castling = castling
+        self.enPassant = enPassant
+        self.halfmoveClock = halfmoveClock
+
+
 class Board(object):  # Square objects are assigned a location on a
-    grid: list  # [list[Square]] # two-dimensional gridded 'board'
+    # two-dimensional gridded 'board' (see the grid and squares properties)
+    mailbox: list  # [Piece] the piece on each square, indexed by bit number
     numRows: int = 8
     numColumns: int = 8
+    # one bitboard per piece type and player, plus occupancy for each player
+    pieceBoards: dict  # {player: {piece name: int}}
+    occupied: dict  # {player: int}
+    # squares attacked by the piece on each square, and the union of those for
+    # each player (None until it is next needed after a change)
+    attacks: list  # [int]
+    attackMaps: dict  # {player: int}
+    kingSquares: dict  # {player: index of their king's square}
+    history: list  # [Undo] moves that can be taken back with unmake_move
+    hash: int  # Zobrist hash of the position, apart from the side to move
+    # moves since the last capture or pawn move (for the fifty-move rule), and
+    # the number of the current move, counting from 1 and going up after black's
+    halfmoveClock: int
+    fullmoveNumber: int
 
     opponent = opponent  # stealing function for getting the opposite player
 
     # Begin by initiating grid
     def __init__(self):
-        self.grid = [[
-            Square(gridRow, gridColumn)
-            for gridColumn in range(self.numColumns)
-        ] for gridRow in range(self.numRows)]
-
-        self.king1 = WhiteKing()
-        self.king2 = BlackKing()
-
-    # Need quick access to the king for each side to speed up program
-    def getKing(self, player) -> King:
-        if player == 1:
-            return self.king1
-        elif player == 2:
-            return self.king2
+        self.pieceBoards = {
+            player: {name: EMPTY for name in PIECE_NAMES} for player in (1, 2)
+        }
+        self.occupied = {1: EMPTY, 2: EMPTY}
+        self.attacks = [EMPTY] * 64
+        self.attackMaps = {1: EMPTY, 2: EMPTY}
+        self.kingSquares = {1: None, 2: None}
+        self.history = []
+        self.hash = CASTLING_KEYS[0]
+        self._castling = 0
+        self._enPassant = None
+        self.halfmoveClock = 0
+        self.fullmoveNumber = 1
+        self.mailbox = [None] * 64
+        self._squares = None
+        self._grid = None
+
+    # Copy of the position that can be played on without affecting this one.
+    # Pieces are shared flyweights and everything else is a flat list or a
+    # small dict of integers, so nothing has to be rebuilt square by square
+    def clone(self) -> "Board":
+        other = Board.__new__(Board)
+        other.pieceBoards = {player: dict(pieces) for player, pieces in self.pieceBoards.items()}
+        other.occupied = dict(self.occupied)
+        other.attacks = self.attacks[:]
+        other.attackMaps = dict(self.attackMaps)
+        other.kingSquares = dict(self.kingSquares)
+        other.history = self.history[:]
+        other.hash = self.hash
+        other._castling = self._castling
+        other._enPassant = self._enPassant
+        other.halfmoveClock = self.halfmoveClock
+        other.fullmoveNumber = self.fullmoveNumber
+        other.mailbox = self.mailbox[:]
+        other._squares = None
+        other._grid = None
+        return other
+
+    # Square objects, indexed by bit number, made the first time they are asked
+    # for (clones used for analysis usually never need them)
+    @property
+    def squares(self) -> list:
+        if self._squares is None:
+            self._squares = [Square(index // 8, index % 8, thisBoard=self) for index in range(64)]
+        return self._squares
+
+    # The same squares as a list of rows
+    @property
+    def grid(self) -> list:
+        if self._grid is None:
+            squares = self.squares
+            self._grid = [squares[row * 8:row * 8 + 8] for row in range(self.numRows)]
+        return self._grid
+
+    # Put a piece on (or, with None, take it off of) a square, keeping the
+    # bitboards in line with the mailbox
+    def placePiece(self, index: int, newPiece: Piece):
+        oldPiece = self.mailbox[index]
+        self.mailbox[index] = newPiece
+        mask = bit(index)
+        if oldPiece is not None:
+            self.pieceBoards[oldPiece.player][oldPiece.name] &= ~mask
+            self.occupied[oldPiece.player] &= ~mask
+            self.attackMaps[oldPiece.player] = None
+            self.hash ^= PIECE_KEYS[oldPiece.player][oldPiece.name][index]
+            if isinstance(oldPiece, King) and self.kingSquares[oldPiece.player] == index:
+                self.kingSquares[oldPiece.player] = None
+        if newPiece is not None:
+            self.pieceBoards[newPiece.player][newPiece.name] |= mask
+            self.occupied[newPiece.player] |= mask
+            self.attackMaps[newPiece.player] = None
+            self.hash ^= PIECE_KEYS[newPiece.player][newPiece.name][index]
+            self.attacks[index] = self.pieceAttacks(index, newPiece)
+            if isinstance(newPiece, King):
+                self.kingSquares[newPiece.player] = index
         else:
-            raise ValueError("Player can be either 1 or 2")
+            self.attacks[index] = EMPTY
+        self.updateRays(mask)
+
+    # Only bishops, rooks and queens that reach the changed square have their
+    # attacks cut short or extended by it, so just those are recomputed
+    def updateRays(self, mask: int):
+        for player in (1, 2):
+            pieces = self.pieceBoards[player]
+            sliders = (pieces["bishop"] | pieces["rook"] | pieces["queen"]) & ~mask
+            for index in indices(sliders):
+                if self.attacks[index] & mask:
+                    self.attacks[index] = self.attacksFrom(index, self.mailbox[index])
+                    self.attackMaps[player] = None
+
+    # Which castling moves are still allowed (bits of ALL_CASTLING).  Castling
+    # rights and the en passant square are part of the hash, so setting either
+    # one keeps the hash up to date
+    @property
+    def castling(self) -> int:
+        return self._castling
+
+    @castling.setter
+    def castling(self, rights: int):
+        self.hash ^= CASTLING_KEYS[self._castling] ^ CASTLING_KEYS[rights]
+        self._castling = rights
+
+    # Square a pawn can move to when capturing "en passant", or None
+    @property
+    def enPassant(self) -> int:
+        return self._enPassant
+
+    @enPassant.setter
+    def enPassant(self, index: int):
+        if self._enPassant is not None:
+            self.hash ^= EN_PASSANT_KEYS[self._enPassant % 8]
+        if index is not None:
+            self.hash ^= EN_PASSANT_KEYS[index % 8]
+        self._enPassant = index
+
+    # Zobrist hash of the whole position with the given player to move
+    def positionHash(self, player: int) -> int:
+        if player == 2:
+            return self.hash ^ SIDE_KEY
+        return self.hash
+
+    # Translate a bitboard back into the squares it covers
+    def squaresIn(self, board: int) -> frozenset:
+        return frozenset(self.squares[index] for index in indices(board))
+
+    # Every square attacked by a (non-pawn) piece standing on the given index,
+    # including squares held by its own side
+    def attacksFrom(self, index: int, piece: Piece) -> int:
+        if piece.scalable:
+            return slidingAttacks(index, piece.moves, self.occupied[1] | self.occupied[2])
+        return STEP_ATTACKS[piece.name][index]
+
+    # Squares threatened by any piece, pawns included
+    def pieceAttacks(self, index: int, piece: Piece) -> int:
+        if isinstance(piece, Pawn):
+            return PAWN_ATTACKS[piece.player][index]
+        return self.attacksFrom(index, piece)
+
+    # Bitboard of every square the aggressor attacks, rebuilt from the
+    # per-square attacks only when a piece of theirs has changed since
+    def attackMask(self, aggressor: int) -> int:
+        attackMap = self.attackMaps[aggressor]
+        if attackMap is None:
+            attackMap = EMPTY
+            for index in indices(self.occupied[aggressor]):
+                attackMap |= self.attacks[index]
+            self.attackMaps[aggressor] = attackMap
+        return attackMap
 
     # This method sets up each individual piece on the 'grid'
     def setup(self):
@@ -105,169 +416,85 @@ class Board(object):  # Square objects are assigned a location on a
         [self.grid[7][column].setPiece(BlackBishop()) for column in [2, 5]]
         self.grid[0][3].setPiece(WhiteQueen())
         self.grid[7][3].setPiece(BlackQueen())
-        self.grid[0][4].setPiece(self.king1)
-        self.king1.location = self.grid[0][4]
-        self.grid[7][4].setPiece(self.king2)
-        self.king2.location = self.grid[7][4]
-
-    # Draw the board onto the screen with unicode ASCII characters (old school, yes)
+        self.grid[0][4].setPiece(WhiteKing())
+        self.grid[7][4].setPiece(BlackKing())
+        self.castling = ALL_CASTLING
+
+    # Where the pieces stand, written as in FEN: rows from 8 down to 1, white
+    # pieces in capitals and runs of empty squares as a number, i.e.:
+    # "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR"
+    def placement(self) -> str:
+        rows = []
+        for row in range(self.numRows - 1, -1, -1):
+            text = ""
+            empty = 0
+            for piece in self.mailbox[row * 8:row * 8 + 8]:
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                text += piece.letter.upper() if piece.player == 1 else piece.letter
+            rows.append(text + str(empty) if empty else text)
+        return "/".join(rows)
+
+    # Put pieces on the board from text written as above
+    def setPlacement(self, text: str):
+        rows = text.split("/")
+        if len(rows) != self.numRows:
+            raise ValueError("Piece placement must have 8 rows")
+        for rowNumber, rowText in enumerate(rows):
+            row = self.numRows - 1 - rowNumber
+            column = 0
+            for character in rowText:
+                if character in "12345678":
+                    column += int(character)
+                    continue
+                if character not in PIECES_BY_LETTER or column >= self.numColumns:
+                    raise ValueError("Invalid piece placement: " + repr(text))
+                self.placePiece(row * 8 + column, PIECES_BY_LETTER[character])
+                column += 1
+            if column != self.numColumns:
+                raise ValueError("Invalid piece placement: " + repr(text))
+
+    # The castling rights out of those given whose king and rook are still on
+    # their starting squares
+    def possibleCastling(self, rights: int) -> int:
+        for right, (player, kingIndex, rookIndex) in CASTLING_SQUARES.items():
+            if self.mailbox[kingIndex] is not PIECES[("king", player)] or \
+                    self.mailbox[rookIndex] is not PIECES[("rook", player)]:
+                rights &= ~right
+        return rights
+
+    # The board as HTML with unicode pieces, from white's side for player 1
+    # and black's for player 2.  Looked up by position first, since a page is
+    # drawn on every poll and most of those are of a position that has
+    # already been drawn
     def draw(self, player: int) -> str:
-
-        if player == 1:
-            return "<br>" + \
-"<div class=\"white\"></div>" + \
-"<div class=\"white toplabel\">a</div>" + \
-"<div class=\"white toplabel\">b</div>" + \
-"<div class=\"white toplabel\">c</div>" + \
-"<div class=\"white toplabel\">d</div>" + \
-"<div class=\"white toplabel\">e</div>" + \
-"<div class=\"white toplabel\">f</div>" + \
-"<div class=\"white toplabel\">g</div>" + \
-"<div class=\"white toplabel\">h</div><br>" + \
-"<div class=\"white leftlabel\">8</div>" + \
-str(self.grid[7][0]) + str(self.grid[7][1]) + \
-str(self.grid[7][2]) + str(self.grid[7][3]) + \
-str(self.grid[7][4]) + str(self.grid[7][5]) + \
-str(self.grid[7][6]) + str(self.grid[7][7]) + \
-"<div class=\"white rightlabel\">8</div><br>" + \
-"<div class=\"white leftlabel\">7</div>" + \
-str(self.grid[6][0]) + str(self.grid[6][1]) + \
-str(self.grid[6][2]) + str(self.grid[6][3]) + \
-str(self.grid[6][4]) + str(self.grid[6][5]) + \
-str(self.grid[6][6]) + str(self.grid[6][7]) + \
-"<div class=\"white rightlabel\">7</div><br>" + \
-"<div class=\"white leftlabel\">6</div>" + \
-str(self.grid[5][0]) + str(self.grid[5][1]) + \
-str(self.grid[5][2]) + str(self.grid[5][3]) + \
-str(self.grid[5][4]) + str(self.grid[5][5]) + \
-str(self.grid[5][6]) + str(self.grid[5][7]) + \
-"<div class=\"white rightlabel\">6</div><br>" + \
-"<div class=\"white leftlabel\">5</div>" + \
-str(self.grid[4][0]) + str(self.grid[4][1]) + \
-str(self.grid[4][2]) + str(self.grid[4][3]) + \
-str(self.grid[4][4]) + str(self.grid[4][5]) + \
-str(self.grid[4][6]) + str(self.grid[4][7]) + \
-"<div class=\"white rightlabel\">5</div><br>" + \
-"<div class=\"white leftlabel\">4</div>" + \
-str(self.grid[3][0]) + str(self.grid[3][1]) + \
-str(self.grid[3][2]) + str(self.grid[3][3]) + \
-str(self.grid[3][4]) + str(self.grid[3][5]) + \
-str(self.grid[3][6]) + str(self.grid[3][7]) + \
-"<div class=\"white rightlabel\">4</div><br>" + \
-"<div class=\"white leftlabel\">3</div>" + \
-str(self.grid[2][0]) + str(self.grid[2][1]) + \
-str(self.grid[2][2]) + str(self.grid[2][3]) + \
-str(self.grid[2][4]) + str(self.grid[2][5]) + \
-str(self.grid[2][6]) + str(self.grid[2][7]) + \
-"<div class=\"white rightlabel\">3</div><br>" + \
-"<div class=\"white leftlabel\">2</div>" + \
-str(self.grid[1][0]) + str(self.grid[1][1]) + \
-str(self.grid[1][2]) + str(self.grid[1][3]) + \
-str(self.grid[1][4]) + str(self.grid[1][5]) + \
-str(self.grid[1][6]) + str(self.grid[1][7]) + \
-"<div class=\"white rightlabel\">2</div><br>" + \
-"<div class=\"white leftlabel\">1</div>" + \
-str(self.grid[0][0]) + str(self.grid[0][1]) + \
-str(self.grid[0][2]) + str(self.grid[0][3]) + \
-str(self.grid[0][4]) + str(self.grid[0][5]) + \
-str(self.grid[0][6]) + str(self.grid[0][7]) + \
-"<div class=\"white rightlabel\">1</div><br>" + \
-"<div class=\"white\">&nbsp;</div>" + \
-"<div class=\"white bottomlabel\">a</div>" + \
-"<div class=\"white bottomlabel\">b</div>" + \
-"<div class=\"white bottomlabel\">c</div>" + \
-"<div class=\"white bottomlabel\">d</div>" + \
-"<div class=\"white bottomlabel\">e</div>" + \
-"<div class=\"white bottomlabel\">f</div>" + \
-"<div class=\"white bottomlabel\">g</div>" + \
-"<div class=\"white bottomlabel\">h</div><br><br>"
-
-
-        # Show board from the other side for player 2
-        elif player == 2:
-            return "<br>" + \
-"<div class=\"white\"></div>" + \
-"<div class=\"white toplabel\">h</div>" + \
-"<div class=\"white toplabel\">g</div>" + \
-"<div class=\"white toplabel\">f</div>" + \
-"<div class=\"white toplabel\">e</div>" + \
-"<div class=\"white toplabel\">d</div>" + \
-"<div class=\"white toplabel\">c</div>" + \
-"<div class=\"white toplabel\">b</div>" + \
-"<div class=\"white toplabel\">a</div><br>" + \
-"<div class=\"white leftlabel\">1</div>" + \
-str(self.grid[0][7]) + str(self.grid[0][6]) + \
-str(self.grid[0][5]) + str(self.grid[0][4]) + \
-str(self.grid[0][3]) + str(self.grid[0][2]) + \
-str(self.grid[0][1]) + str(self.grid[0][0]) + \
-"<div class=\"white rightlabel\">1</div><br>" + \
-"<div class=\"white leftlabel\">2</div>" + \
-str(self.grid[1][7]) + str(self.grid[1][6]) + \
-str(self.grid[1][5]) + str(self.grid[1][4]) + \
-str(self.grid[1][3]) + str(self.grid[1][2]) + \
-str(self.grid[1][1]) + str(self.grid[1][0]) + \
-"<div class=\"white rightlabel\">2</div><br>" + \
-"<div class=\"white leftlabel\">3</div>" + \
-str(self.grid[2][7]) + str(self.grid[2][6]) + \
-str(self.grid[2][5]) + str(self.grid[2][4]) + \
-str(self.grid[2][3]) + str(self.grid[2][2]) + \
-str(self.grid[2][1]) + str(self.grid[2][0]) + \
-"<div class=\"white rightlabel\">3</div><br>" + \
-"<div class=\"white leftlabel\">4</div>" + \
-str(self.grid[3][7]) + str(self.grid[3][6]) + \
-str(self.grid[3][5]) + str(self.grid[3][4]) + \
-str(self.grid[3][3]) + str(self.grid[3][2]) + \
-str(self.grid[3][1]) + str(self.grid[3][0]) + \
-"<div class=\"white rightlabel\">4</div><br>" + \
-"<div class=\"white leftlabel\">5</div>" + \
-str(self.grid[4][7]) + str(self.grid[4][6]) + \
-str(self.grid[4][5]) + str(self.grid[4][4]) + \
-str(self.grid[4][3]) + str(self.grid[4][2]) + \
-str(self.grid[4][1]) + str(self.grid[4][0]) + \
-"<div class=\"white rightlabel\">5</div><br>" + \
-"<div class=\"white leftlabel\">6</div>" + \
-str(self.grid[5][7]) + str(self.grid[5][6]) + \
-str(self.grid[5][5]) + str(self.grid[5][4]) + \
-str(self.grid[5][3]) + str(self.grid[5][2]) + \
-str(self.grid[5][1]) + str(self.grid[5][0]) + \
-"<div class=\"white rightlabel\">6</div><br>" + \
-"<div class=\"white leftlabel\">7</div>" + \
-str(self.grid[6][7]) + str(self.grid[6][6]) + \
-str(self.grid[6][5]) + str(self.grid[6][4]) + \
-str(self.grid[6][3]) + str(self.grid[6][2]) + \
-str(self.grid[6][1]) + str(self.grid[6][0]) + \
-"<div class=\"white rightlabel\">7</div><br>" + \
-"<div class=\"white leftlabel\">8</div>" + \
-str(self.grid[7][7]) + str(self.grid[7][6]) + \
-str(self.grid[7][5]) + str(self.grid[7][4]) + \
-str(self.grid[7][3]) + str(self.grid[7][2]) + \
-str(self.grid[7][1]) + str(self.grid[7][0]) + \
-"<div class=\"white rightlabel\">8</div><br>" + \
-"<div class=\"white\">&nbsp;</div>" + \
-"<div class=\"white bottomlabel\">h</div>" + \
-"<div class=\"white bottomlabel\">g</div>" + \
-"<div class=\"white bottomlabel\">f</div>" + \
-"<div class=\"white bottomlabel\">e</div>" + \
-"<div class=\"white bottomlabel\">d</div>" + \
-"<div class=\"white bottomlabel\">c</div>" + \
-"<div class=\"white bottomlabel\">b</div>" + \
-"<div class=\"white bottomlabel\">a</div><br><br>"
-
-        else:
+        if player not in BOARD_TEMPLATES:
             raise ValueError("Need input of 1 or 2")
+        key = (self.hash, player)
+        html = boardCache.get(key)
+        if html is None:
+            mailbox = self.mailbox
+            template, order = BOARD_TEMPLATES[player]
+            html = template.format(*[SQUARE_HTML[index][mailbox[index]] for index in order])
+            boardCache.put(key, html)
+        return html
 
     # See if a square is on the board before calling getSquare
 
     # Reference a particular square on the grid
     def getSquare(self, row: int, column: int) -> Square:
-        if row in range(self.numRows) and column in range(self.numColumns):
-            return self.grid[row][column]
+        if 0 <= row < 8 and 0 <= column < 8:
+            return self.squares[row * 8 + column]
         else:
             raise ValueError("Please use 0-7 indices")
 
     # Get all possible moves (even if capturing a piece)
-    # For this to work, the piece is "walked" along the board until
-    # it runs out or hits an opponent or neighbor
+    # The piece's attacks are looked up as a bitboard, and then any squares
+    # held by its own side are removed
     def getMoves(self, start: Square) -> frozenset:
         if start is None:
             return frozenset()
@@ -278,90 +505,45 @@ str(self.grid[7][1]) + str(self.grid[7][0]) + \
                 if start.piece.moves is None:
                     return frozenset()
                 else:
-                    moves = frozenset()
                     player: int = start.piece.player
-                    otherPlayer: int = opponent(player)
-
-                    # Grab all movement directions applicable to the piece
-                    for vector in start.piece.moves:
-                        square = start  # need for initial condition
-
-                        # Move along the direction of the move (dubbed vector)
-                        while True:
-                            row = square.row + vector[0]
-                            column = square.column + vector[1]
-                            if not Square.isSquare(row, column):  # Walk until hitting an edge
-                                break
-                            else:
-                                square = self.getSquare(row, column)
-                                if square.piece is None:
-                                    moves = moves.union([square])
-                                    if not start.piece.scalable:  # Stop if limited to move one square only
-                                        break
-                                # Stop if opponent is encountered (capture)
-                                elif square.piece.player == otherPlayer:
-                                    moves = moves.union([square])
-                                    break
-                                else:  # Go until the end
-                                    break
-                    return moves
+                    moves = self.attacksFrom(start.index, start.piece) & ~self.occupied[player]
+                    return self.squaresIn(moves)
 
     # Pawns are unique in only moving one direction, capturing pieces at an angle, and more.
     # As a result, they have their own method for movement
     def getPawnMoves(self, square: Square) -> frozenset:
-        moves = frozenset()
         if square.piece is None:
-            return moves
+            return frozenset()
         if isinstance(square.piece, Pawn):
-            row = square.row
-            column = square.column
             player = square.piece.player
-            square.piece.enPassant = False  # reset this flag: good for only one move
+            otherPlayer = opponent(player)
+            index = square.index
+            empty = FULL ^ (self.occupied[1] | self.occupied[2])
 
             # Work with both sides, which have opposing directions
             if player == 1:
-                direction = 1
+                step = 8
             else:
-                direction = -1
-
-            # Check to see if the diagonal moves contain an opposing piece and add
-            if Square.isSquare(row + direction, column + 1):
-                east = self.getSquare(row + direction, column + 1)
-                if east.piece is not None and east.piece.player == opponent(player):
-                    moves = moves.union([east])
-            if Square.isSquare(row + direction, column - 1):
-                west = self.getSquare(row + direction, column - 1)
-                if west.piece is not None and west.piece.player == opponent(player):
-                    moves = moves.union([west])
+                step = -8
+
+            # Diagonal moves are only allowed onto an opposing piece
+            attacks = PAWN_ATTACKS[player][index]
+            moves = attacks & self.occupied[otherPlayer]
 
             # Check for forward one square and two square movements
-            if Square.isSquare(row + direction, column):
-                forward = self.getSquare(row + direction, column)
-                if forward.piece is None:
-                    moves = moves.union([forward])
-                    if Square.isSquare(row + 2 * direction, column) and not square.piece.moved:
-                        forwardTwo = self.getSquare(row + 2 * direction, column)
-                        if forwardTwo.piece is None:
-                            moves = moves.union([forwardTwo])
+            forward = bit(index + step) & empty if 0 <= index + step < 64 else EMPTY
+            moves |= forward
+            if forward and square.row == (1 if player == 1 else 6):
+                moves |= bit(index + 2 * step) & empty
 
             # "En Passant" check: allows pawns the opportunity to take an enemy pawn
-            # that bypassed them by moving two squares ahead
-            if Square.isSquare(row, column + 1):
-                checkSquare = self.getSquare(row, column + 1)
-                if isinstance(checkSquare.piece, Pawn) and \
-                        checkSquare.piece.player == opponent(player) and \
-                        checkSquare.piece.enPassant:
-                    moves = moves.union([self.getSquare(row + direction, column + 1)])
-
-            # ...on both sides
-            if Square.isSquare(row, column - 1):
-                checkSquare = self.getSquare(row, column - 1)
-                if isinstance(checkSquare.piece, Pawn) and \
-                        checkSquare.piece.player == opponent(player) and \
-                        checkSquare.piece.enPassant:
-                    moves = moves.union([self.getSquare(row + direction, column - 1)])
-
-            return moves
+            # that bypassed them by moving two squares ahead (on both sides)
+            if self.enPassant is not None and attacks & bit(self.enPassant):
+                bypassed = self.mailbox[self.enPassant - step]
+                if isinstance(bypassed, Pawn) and bypassed.player == otherPlayer:
+                    moves |= bit(self.enPassant)
+
+            return self.squaresIn(moves)
         else:
             raise ValueError("Square does not contain a pawn")
 
@@ -369,127 +551,238 @@ str(self.grid[7][1]) + str(self.grid[7][0]) + \
     # There are two castling directions: King-side (4 squares wide) and Queen-side (5 squares wide)
     # This method adds those moves only if they are eligible (not in check, path clear, etc)
     def getKingMoves(self, player: int) -> frozenset:
-        moves = frozenset()
-        checkZone = self.checkZone(opponent(player))  # Saves some processing to grab this
-        king = self.getKing(player)
-        if king.moved:
-            return moves
-        if king.location in checkZone:
-            return moves
-        row = king.location.row
-        kingColumn = king.location.column
-        rookColumn = 0
-        rookSquare = self.getSquare(row, rookColumn)
-        if isinstance(rookSquare.piece, Rook) and not rookSquare.piece.moved:
-            kingMove1 = self.getSquare(row, kingColumn - 1)
-            kingMove2 = self.getSquare(row, kingColumn - 2)
-            if kingMove1.piece is None and kingMove2.piece is None and \
-                    kingMove1 not in checkZone and \
-                    kingMove2 not in checkZone:
-                moves = moves.union([kingMove2])
-        rookColumn = 7
-        rookSquare = self.getSquare(row, rookColumn)
-        if isinstance(rookSquare.piece, Rook) and not rookSquare.piece.moved:
-            kingMove1 = self.getSquare(row, kingColumn + 1)
-            kingMove2 = self.getSquare(row, kingColumn + 2)
-            if kingMove1.piece is None and kingMove2.piece is None and \
-                    kingMove1 not in checkZone and \
-                    kingMove2 not in checkZone:
-                moves = moves.union([kingMove2])
+        return self.squaresIn(self.castlingMask(player))
+
+    # Bitboard version of the above: the squares the king can castle to
+    def castlingMask(self, player: int) -> int:
+        if player == 1:
+            kingSide, queenSide = WHITE_KING_SIDE, WHITE_QUEEN_SIDE
+        else:
+            kingSide, queenSide = BLACK_KING_SIDE, BLACK_QUEEN_SIDE
+        kingIndex = self.kingSquares[player]
+        if not self.castling & (kingSide | queenSide) or kingIndex != CASTLING_SQUARES[kingSide][1]:
+            return EMPTY
+        checkZone = self.attackMask(opponent(player))  # Saves some processing to grab this
+        if bit(kingIndex) & checkZone:
+            return EMPTY
+        occupied = self.occupied[1] | self.occupied[2]
+        moves = EMPTY
+        for right, rookColumn, kingEnd in ((queenSide, 0, kingIndex - 2), (kingSide, 7, kingIndex + 2)):
+            rookIndex = kingIndex - kingIndex % 8 + rookColumn
+            rook = self.mailbox[rookIndex]
+            if self.castling & right and isinstance(rook, Rook) and rook.player == player:
+                kingPath = BETWEEN[kingIndex][kingEnd] | bit(kingEnd)
+                if not BETWEEN[kingIndex][rookIndex] & occupied and not kingPath & checkZone:
+                    moves |= bit(kingEnd)
         return moves
 
     # Combines all possible moves from one player to see where
     # the opponent's king would be in check or not
     def checkZone(self, aggressor: int) -> frozenset:
-        checkZone = frozenset()
-        for checkRow in self.grid:
-            for checkSquare in checkRow:
-                if checkSquare.piece is not None:
-                    if checkSquare.piece.player == aggressor:
-                        # Again, pawns are unique in their movements, so they are added separately
-                        if isinstance(checkSquare.piece, Pawn):
-                            if aggressor == 1:
-                                if Square.isSquare(checkSquare.row + 1, checkSquare.column + 1):
-                                    checkZone = checkZone.union([self.getSquare(
-                                        checkSquare.row + 1,
-                                        checkSquare.column + 1)])
-                                if Square.isSquare(checkSquare.row + 1, checkSquare.column - 1):
-                                    checkZone = checkZone.union([self.getSquare(
-                                        checkSquare.row + 1,
-                                        checkSquare.column - 1)])
-                            else:
-                                if Square.isSquare(checkSquare.row - 1, checkSquare.column + 1):
-                                    checkZone = checkZone.union([self.getSquare(
-                                        checkSquare.row - 1,
-                                        checkSquare.column + 1)])
-                                if Square.isSquare(checkSquare.row - 1, checkSquare.column - 1):
-                                    checkZone = checkZone.union([self.getSquare(
-                                        checkSquare.row - 1,
-                                        checkSquare.column - 1)])
-                        else:
-                            checkZone = checkZone.union(
-                                self.getMoves(checkSquare))
-        return checkZone
+        return self.squaresIn(self.attackMask(aggressor))
 
     # Applies the above method to a specific piece
     def check(self, player: int) -> bool:
-        return self.getKing(player).location in self.checkZone(opponent(player))
-
-    # For all moves on one side, move each piece once to see if the king would still be in check (checkmate)
-    # The pieces are walked back from the check to preserve the layout
-    # Castling is not considered due to check restrictions:
-    # "cannot castle into, out of, or through check"
+        return bool(self.pieceBoards[player]["king"] & self.attackMask(opponent(player)))
+
+    # Every piece of the aggressor's that attacks a square, given which squares
+    # are occupied (so a piece can be left out when looking past it)
+    def attackersTo(self, index: int, aggressor: int, occupied: int) -> int:
+        pieces = self.pieceBoards[aggressor]
+        return (KNIGHT_ATTACKS[index] & pieces["knight"]) | \
+            (KING_ATTACKS[index] & pieces["king"]) | \
+            (PAWN_ATTACKS[opponent(aggressor)][index] & pieces["pawn"]) | \
+            (slidingAttacks(index, Rook.moves, occupied) & (pieces["rook"] | pieces["queen"])) | \
+            (slidingAttacks(index, Bishop.moves, occupied) & (pieces["bishop"] | pieces["queen"]))
+
+    # Own pieces that cannot leave the line between their king and an enemy
+    # bishop, rook or queen, mapped to the squares they may still move to
+    def pins(self, player: int, kingIndex: int) -> dict:
+        pins = {}
+        pieces = self.pieceBoards[opponent(player)]
+        occupied = self.occupied[1] | self.occupied[2]
+        for vector, rays in RAYS.items():
+            blockers = rays[kingIndex] & occupied
+            if not blockers:
+                continue
+            first = firstBlocker(vector, blockers)
+            if not self.occupied[player] & bit(first):
+                continue
+            blockers ^= bit(first)
+            if not blockers:
+                continue
+            pinner = firstBlocker(vector, blockers)
+            if vector in Rook.moves:
+                sliders = pieces["rook"] | pieces["queen"]
+            else:
+                sliders = pieces["bishop"] | pieces["queen"]
+            if sliders & bit(pinner):
+                pins[first] = BETWEEN[kingIndex][pinner] | bit(pinner)
+        return pins
+
+    # Yield every legal move for a player, optionally only for the pieces on
+    # the given origin squares.  Checks and pins are found up front, so only
+    # en passant captures need to be tried on the board
+    def generate_legal_moves(self, player: int, origins: int = FULL):
+        otherPlayer = opponent(player)
+        own = self.occupied[player]
+        occupied = own | self.occupied[otherPlayer]
+        pieces = self.pieceBoards[player]
+        kingIndex = self.kingSquares[player]
+        if kingIndex is None:
+            return
+        kingBoard = bit(kingIndex)
+
+        # The king may step anywhere not attacked once it has left its square
+        if kingBoard & origins:
+            for end in indices(KING_ATTACKS[kingIndex] & ~own):
+                if not self.attackersTo(end, otherPlayer, occupied ^ kingBoard):
+                    yield Move(kingIndex, end)
+            for end in indices(self.castlingMask(player)):
+                yield Move(kingIndex, end)
+
+        # In check, other pieces must capture the checking piece or block it,
+        # and nothing but the king can answer two checks at once
+        checkers = self.attackersTo(kingIndex, otherPlayer, occupied)
+        if checkers:
+            if checkers & (checkers - 1):
+                return
+            checker = checkers.bit_length() - 1
+            evasions = checkers | BETWEEN[kingIndex][checker]
+        else:
+            evasions = FULL
+        pins = self.pins(player, kingIndex)
+        targets = ~own & evasions
+
+        for name in ("knight", "bishop", "rook", "queen"):
+            for start in indices(pieces[name] & origins):
+                if name == "knight":
+                    ends = KNIGHT_ATTACKS[start] & targets
+                else:
+                    ends = slidingAttacks(start, self.mailbox[start].moves, occupied) & targets
+                if start in pins:
+                    ends &= pins[start]
+                for end in indices(ends):
+                    yield Move(start, end)
+
+        step = 8 if player == 1 else -8
+        startRow = 1 if player == 1 else 6
+        for start in indices(pieces["pawn"] & origins):
+            ends = PAWN_ATTACKS[player][start] & self.occupied[otherPlayer]
+            if 0 <= start + step < 64 and not occupied & bit(start + step):
+                ends |= bit(start + step)
+                if start // 8 == startRow and not occupied & bit(start + 2 * step):
+                    ends |= bit(start + 2 * step)
+            ends &= evasions
+            if start in pins:
+                ends &= pins[start]
+            for end in indices(ends):
+                if end // 8 == 0 or end // 8 == 7:
+                    for promotion in ("queen", "rook", "bishop", "knight"):
+                        yield Move(start, end, promotion)
+                else:
+                    yield Move(start, end)
+            if self.enPassant is not None and PAWN_ATTACKS[player][start] & bit(self.enPassant):
+                move = Move(start, self.enPassant)
+                self.make_move(move)
+                safe = not self.check(player)
+                self.unmake_move()
+                if safe:
+                    yield move
+
+    # Stop at the first legal move found, trying the cheapest ones first: a
+    # king step (which also covers castling, since castling needs the square
+    # next to the king to be safe), then a capture of a lone checking piece
+    def has_legal_move(self, player: int) -> bool:
+        otherPlayer = opponent(player)
+        own = self.occupied[player]
+        occupied = own | self.occupied[otherPlayer]
+        kingIndex = self.kingSquares[player]
+        if kingIndex is None:
+            return False
+        kingBoard = bit(kingIndex)
+        for end in indices(KING_ATTACKS[kingIndex] & ~own):
+            if not self.attackersTo(end, otherPlayer, occupied ^ kingBoard):
+                return True
+        checkers = self.attackersTo(kingIndex, otherPlayer, occupied)
+        if checkers & (checkers - 1):
+            return False
+        if checkers:
+            captors = self.attackersTo(checkers.bit_length() - 1, player, occupied) & ~kingBoard
+            for move in self.generate_legal_moves(player, captors):
+                return True
+        for move in self.generate_legal_moves(player, FULL ^ kingBoard):
+            return True
+        return False
+
+    # A player in check with no legal move to get out of it is checkmated
     def checkmate(self, forPlayer: int) -> bool:
-        checkmated = True
-        for row in self.grid:
-            for square in row:
-                if square.piece is not None and square.piece.player == forPlayer:
-                    if isinstance(square.piece, Pawn):
-                        testMoves = self.getPawnMoves(square)
-                    else:
-                        testMoves = self.getMoves(square)
-                    if testMoves is not None:
-                        for move in testMoves:
-                            pieceSaved = False
-                            savedPiece = None
-                            if move.piece is not None:
-                                pieceSaved = True
-                                savedPiece = move.piece
-                            move.piece = square.piece
-                            square.piece = None
-                            if isinstance(move.piece, King):
-                                self.getKing(forPlayer).location = move
-                            if not self.check(forPlayer):
-                                checkmated = False
-                            square.piece = move.piece
-                            if isinstance(square.piece, King):
-                                self.getKing(forPlayer).location = square
-                            if pieceSaved:
-                                move.piece = savedPiece
-                            else:
-                                move.piece = None
-        return checkmated
-
-    # If no moves are possible for a given side, then there is a stalemate
+        return self.check(forPlayer) and not self.has_legal_move(forPlayer)
+
+    # If no legal moves are possible for a given side (without being in
+    # check), then there is a stalemate
     def stalemate(self, player: int) -> bool:
-        stalemate = False
-        moves = frozenset()
-        for row in self.grid:
-            for square in row:
-                if square is not None:
-                    if square.piece is not None:
-                        if square.piece.player == player:
-                            if isinstance(square.piece, King):
-                                moves = moves.union(
-                                    self.getMoves(square).union(
-                                        self.getKingMoves(player)))
-                            elif isinstance(square.piece, Pawn):
-                                moves = moves.union(self.getPawnMoves(square))
-                            else:
-                                moves = moves.union(self.getMoves(square))
-        if len(moves) == 0:
-            stalemate = True
-        return stalemate
+        return not self.check(player) and not self.has_legal_move(player)
+
+    # Play a move, handling castling, en passant and promotion, and remember
+    # how to take it back.  The move is not checked for legality
+    def make_move(self, move: Move) -> Undo:
+        mailbox = self.mailbox
+        piece = mailbox[move.start]
+        undo = Undo(move, piece, mailbox[move.end], move.end, self.castling, self.enPassant, self.halfmoveClock)
+        self.enPassant = None
+        if isinstance(piece, Pawn) or undo.captured is not None:
+            self.halfmoveClock = 0
+        else:
+            self.halfmoveClock += 1
+        if piece.player == 2:
+            self.fullmoveNumber += 1
+        if isinstance(piece, Pawn):
+            step = 8 if piece.player == 1 else -8
+            if move.end == undo.enPassant and undo.captured is None:
+                undo.capturedIndex = move.end - step
+                undo.captured = mailbox[undo.capturedIndex]
+                self.placePiece(undo.capturedIndex, None)
+            elif move.end - move.start == 2 * step:
+                self.enPassant = move.start + step
+        elif isinstance(piece, King) and abs(move.end - move.start) == 2:
+            rookStart, rookEnd = self.castlingRook(move)
+            self.placePiece(rookEnd, mailbox[rookStart])
+            self.placePiece(rookStart, None)
+        if self.castling and (move.start in CASTLING_LOSS or move.end in CASTLING_LOSS):
+            self.castling &= ~(CASTLING_LOSS.get(move.start, 0) | CASTLING_LOSS.get(move.end, 0))
+        if move.promotion is not None:
+            self.placePiece(move.end, PIECES[(move.promotion, piece.player)])
+        else:
+            self.placePiece(move.end, piece)
+        self.placePiece(move.start, None)
+        self.history.append(undo)
+        return undo
+
+    # Take back the last move played with make_move
+    def unmake_move(self) -> Move:
+        undo = self.history.pop()
+        move = undo.move
+        self.placePiece(move.end, None)
+        self.placePiece(move.start, undo.piece)
+        if undo.captured is not None:
+            self.placePiece(undo.capturedIndex, undo.captured)
+        if isinstance(undo.piece, King) and abs(move.end - move.start) == 2:
+            rookStart, rookEnd = self.castlingRook(move)
+            self.placePiece(rookStart, self.mailbox[rookEnd])
+            self.placePiece(rookEnd, None)
+        self.castling = undo.castling
+        self.enPassant = undo.enPassant
+        self.halfmoveClock = undo.halfmoveClock
+        if undo.piece.player == 2:
+            self.fullmoveNumber -= 1
+        return move
+
+    # Where the rook starts and ends when the king castles with the given move
+    def castlingRook(self, move: Move) -> tuple:
+        if move.end > move.start:
+            return move.start + 3, move.start + 1
+        return move.start - 4, move.start - 1
 
     def toJSON(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -10,8 +10,20 @@
 # ToDo: Keep-alive signal?
 # ToDo: comments, functions, possibly add a class or two (TDB)
 
-from board import Board, Square
-from piecetypes import King, Queen, Bishop, Knight, Rook, Pawn
+import os
+
+from bitboard import indices, squareFromName, squareName
+from board import Board, Move, Square, castlingFromText, castlingToText
+from lru import LRUCache
+from pieces import PIECES
+from piecetypes import King, Pawn
+
+# Results worked out for a position, keyed by its Zobrist hash and shared by
+# every game in the process (page reloads keep asking about the same position)
+positionCache = LRUCache(int(os.environ.get("POSITION_CACHE_SIZE", "4096")))
+
+# Pieces named by the letter that ends a promotion in coordinate notation
+PROMOTIONS_BY_LETTER = {"q": "queen", "r": "rook", "b": "bishop", "n": "knight"}
 
 # Determine whether the string is a code for a square on the board
 def isCode(code: str):
@@ -49,12 +61,79 @@ class Chess(object):
     endSquare: Square
     inCheck: bool
     gameOn: bool = True
+    savedStatus: tuple = None  # (position hash, positionInfo) from the saved game
 
 
-    def __init__(self):
+    # Start from the opening layout, or from an empty board when the pieces
+    # are about to be placed some other way (i.e.: loading a saved game)
+    def __init__(self, setup: bool = True):
         self.board = Board()
-        self.board.setup()
+        if setup:
+            self.board.setup()
 
+    # Independent copy of the game (for trying out moves without touching
+    # this one), with any selected squares pointing into the copied board
+    def clone(self) -> "Chess":
+        other = Chess.__new__(Chess)
+        other.__dict__.update(self.__dict__)
+        other.board = self.board.clone()
+        for name in ("startSquare", "endSquare"):
+            square = self.__dict__.get(name)
+            if square is not None:
+                setattr(other, name, other.board.squares[square.index])
+        return other
+
+    # The position in Forsyth-Edwards Notation, i.e.: the opening position is
+    # "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    def toFEN(self) -> str:
+        board = self.board
+        return " ".join((
+            board.placement(),
+            "w" if self.currentPlayer == 1 else "b",
+            castlingToText(board.castling),
+            squareName(board.enPassant) if board.enPassant is not None else "-",
+            str(board.halfmoveClock),
+            str(board.fullmoveNumber),
+        ))
+
+    # Set up a game from a FEN string.  The move counters may be left off, in
+    # which case they start at 0 and 1
+    @classmethod
+    def fromFEN(cls, fen: str) -> "Chess":
+        fields = fen.split()
+        if not 4 <= len(fields) <= 6:
+            raise ValueError("FEN must have between 4 and 6 fields: " + repr(fen))
+        placement, side, castling, enPassant = fields[:4]
+        if side not in ("w", "b"):
+            raise ValueError("FEN side to move must be \"w\" or \"b\"")
+        if castling != "-" and (not castling or set(castling) - set("KQkq")):
+            raise ValueError("Invalid FEN castling rights: " + repr(castling))
+        chess = cls(False)
+        board = chess.board
+        board.setPlacement(placement)
+        for player in (1, 2):
+            if bin(board.pieceBoards[player]["king"]).count("1") != 1:
+                raise ValueError("FEN must have one king for each side: " + repr(placement))
+        # Rights that the pieces no longer allow are dropped, as other programs
+        # are not always careful to clear them
+        board.castling = board.possibleCastling(castlingFromText(castling))
+        if enPassant != "-":
+            # The square a pawn of the side that just moved skipped over, with
+            # the square it came from now empty
+            index = squareFromName(enPassant)
+            step = -8 if side == "w" else 8
+            if index // 8 != (5 if side == "w" else 2) or \
+                    board.mailbox[index + step] is not PIECES[("pawn", 2 if side == "w" else 1)] or \
+                    board.mailbox[index] is not None or board.mailbox[index - step] is not None:
+                raise ValueError("Invalid FEN en passant square: " + repr(enPassant))
+            board.enPassant = index
+        try:
+            board.halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+            board.fullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        except ValueError as error:
+            raise ValueError("FEN move counters must be numbers") from error
+        chess.currentPlayer = 1 if side == "w" else 2
+        return chess
 
     # Run through every possible error that could result from this move, return blank and move pieces if none
     def movePiece(self, newStart: str, newEnd: str, player: int) -> str:
@@ -70,7 +149,7 @@ class Chess(object):
             self.startSquare = self.board.getSquare(startLocation[0], startLocation[1])
         else:
             return "Please choose a square on the board"
-        if self.startSquare.piece.player != self.currentPlayer:
+        if self.startSquare.piece is None or self.startSquare.piece.player != self.currentPlayer:
             return "Please choose your own piece"
         if isCode(newEnd):
             endLocation = deCode(newEnd)
@@ -84,21 +163,10 @@ class Chess(object):
             return "Please move to an empty square or capture a piece"
         legalMoves = self.findLegalMoves()
         if self.endSquare not in legalMoves:
+            if self.endSquare in self.findPieceMoves():
+                return "This move places you in check, please try again"
             return "Move is illegal"
-        if isinstance(self.startSquare.piece, King) and abs(self.endSquare.column - self.startSquare.column) == 2:
-            return self.castle()
-        if isinstance(self.startSquare.piece, Pawn):
-            self.markEnPassant()
-            if self.isEnPassantAttempt():
-                return self.enPassant()
-        savedPiece = self.endSquare.piece
-        self.endSquare.piece = self.startSquare.piece
-        self.startSquare.piece = None
-        if self.board.check(self.currentPlayer):
-            self.startSquare.piece = self.endSquare.piece
-            self.endSquare.piece = savedPiece
-            return "This move places you in check, please try again"
-        self.endSquare.piece.moved = True
+        self.board.make_move(Move(self.startSquare.index, self.endSquare.index))
         return ""
 
     def drawBoard(self, player: int) -> str:
@@ -107,14 +175,80 @@ class Chess(object):
     def switchPlayers(self):
         self.currentPlayer = Square.opponent(self.currentPlayer)
 
-    # Gather moves possibilities for special pieces and all other pieces, too
+    # Legal moves, check, checkmate and stalemate for the side to move, taken
+    # from the status the game was loaded with or looked up in the position
+    # cache, and only worked out on a miss
+    def positionInfo(self) -> dict:
+        key = self.board.positionHash(self.currentPlayer)
+        if self.savedStatus is not None:
+            if self.savedStatus[0] == key:
+                return self.savedStatus[1]
+            self.savedStatus = None
+        info = positionCache.get(key)
+        if info is None:
+            moves = tuple(self.board.generate_legal_moves(self.currentPlayer))
+            inCheck = self.board.check(self.currentPlayer)
+            info = {
+                "moves": moves,
+                "check": inCheck,
+                "checkmate": inCheck and not moves,
+                "stalemate": not inCheck and not moves,
+            }
+            positionCache.put(key, info)
+        return info
+
+    # The legal moves in coordinate notation, promotions included (i.e.:
+    # ("e7e8b", "e7e8n", "e7e8q", "e7e8r", ...)), as saved with the game
+    def legalMoveCodes(self) -> tuple:
+        info = self.positionInfo()
+        codes = info.get("codes")
+        if codes is None:
+            codes = info["codes"] = tuple(sorted(str(move) for move in info["moves"]))
+        return codes
+
+    # The legal moves as text, i.e.: ("e2e3", "e2e4", ...), worked out once per
+    # position and kept with the rest of its results
+    def legalMoveNames(self) -> tuple:
+        info = self.positionInfo()
+        names = info.get("names")
+        if names is None:
+            names = info["names"] = tuple(sorted({squareName(move.start) + squareName(move.end)
+                                                  for move in info["moves"]}))
+        return names
+
+    # Squares the piece on the start square can legally move to
     def findLegalMoves(self) -> frozenset:
-        if isinstance(self.startSquare.piece, Pawn):
-            return self.board.getPawnMoves(self.startSquare)
-        elif isinstance(self.startSquare.piece, King):
-            return self.board.getMoves(self.startSquare).union(self.board.getKingMoves(self.currentPlayer))
+        start = self.startSquare.index
+        return frozenset(self.board.squares[move.end]
+                         for move in self.positionInfo()["moves"] if move.start == start)
+
+    # Gather moves possibilities for special pieces and all other pieces, too
+    # (whether or not they would leave the king in check), from the start
+    # square or the one given
+    def findPieceMoves(self, start: Square = None) -> frozenset:
+        if start is None:
+            start = self.startSquare
+        if isinstance(start.piece, Pawn):
+            return self.board.getPawnMoves(start)
+        elif isinstance(start.piece, King):
+            return self.board.getMoves(start).union(self.board.getKingMoves(self.currentPlayer))
         else:
-            return self.board.getMoves(self.startSquare)
+            return self.board.getMoves(start)
+
+    # Moves that movePiece turns down for leaving the king in check, as text
+    # like legalMoveNames, worked out once per position
+    def checkedMoveNames(self) -> tuple:
+        info = self.positionInfo()
+        names = info.get("checked")
+        if names is None:
+            legal = set(self.legalMoveNames())
+            squares = self.board.squares
+            names = set()
+            for index in indices(self.board.occupied[self.currentPlayer]):
+                start = squares[index]
+                names.update(squareName(index) + squareName(end.index) for end in self.findPieceMoves(start))
+            names = info["checked"] = tuple(sorted(names - legal))
+        return names
 
     # See if a pawn made it to the other side for a piece promotion
     def promotePawnCheck(self) -> bool:
@@ -125,25 +259,66 @@ class Chess(object):
         else:
             return False
 
-    # Apply the promotion selected for the pawn
+    # Apply the promotion selected for the pawn.  The pawn's move is played
+    # again as a promotion, so the board's history shows what really happened
     def promotePawn(self, promotion: str) -> str:
         if promotion == "1":
-            self.endSquare.piece = Queen(self.currentPlayer)
+            name = "queen"
         elif promotion == "2":
-            self.endSquare.piece = Bishop(self.currentPlayer)
+            name = "bishop"
         elif promotion == "3":
-            self.endSquare.piece = Knight(self.currentPlayer)
+            name = "knight"
         elif promotion == "4":
-            self.endSquare.piece = Rook(self.currentPlayer)
+            name = "rook"
         else:
             return "Invalid selection, please try again"
+        history = self.board.history
+        if history and history[-1].move.end == self.endSquare.index and history[-1].move.promotion is None:
+            move = self.board.unmake_move()
+            self.board.make_move(Move(move.start, move.end, name))
+        else:
+            self.endSquare.piece = PIECES[(name, self.currentPlayer)]
         return ""
 
-    # See if game is over or not.  Be sure to cover this before and after a move
+    # End the game if the side to move is checkmated or stalemated.  Called
+    # once a move has been played, so viewing the game never changes it
+    def updateGameOn(self):
+        info = self.positionInfo()
+        if info["checkmate"] or info["stalemate"]:
+            self.gameOn = False
+
+    # Use the results worked out for this position when it was saved (see
+    # Game.position_status) rather than working them out again.  They are kept
+    # with this game alone, for as long as it stays in that position, and not
+    # shared through positionCache.  Statuses saved before promotions were
+    # written out (i.e.: "e7e8" instead of "e7e8q") are left unused
+    def seedPositionInfo(self, status: dict):
+        board = self.board
+        moves = []
+        for name in status["moves"]:
+            start, end = squareFromName(name[:2]), squareFromName(name[2:4])
+            if len(name) > 4:
+                moves.append(Move(start, end, PROMOTIONS_BY_LETTER[name[4]]))
+            elif isinstance(board.mailbox[start], Pawn) and end // 8 in (0, 7):
+                return
+            else:
+                moves.append(Move(start, end))
+        info = {
+            "moves": tuple(moves),
+            "check": status["check"],
+            "checkmate": status["checkmate"],
+            "stalemate": status["stalemate"],
+        }
+        # Left out of statuses saved before it was added
+        if "checked" in status:
+            info["checked"] = tuple(status["checked"])
+        self.savedStatus = (board.positionHash(self.currentPlayer), info)
+
+    # Describe check, checkmate or stalemate to the player
     def gameStatus(self, player) -> str:
-        if self.board.check(self.currentPlayer):
-            if self.board.checkmate(self.currentPlayer):
-                self.gameOn = False
+        info = self.positionInfo()
+        if info["check"]:
+            if info["checkmate"]:
                 if player == self.currentPlayer:
                     return "<h3 style=\"color: red;\">Checkmate!  You lose!</h3>"
                 else:
@@ -153,60 +328,6 @@ class Chess(object):
                     return "<h3 style=\"color: red;\">You are in check!</h3>"
                 else:
                     return "<h3 style=\"color: green;\">You placed your opponent in check!</h3>"
-        elif self.board.stalemate(self.currentPlayer):
-            self.gameOn = False
+        elif info["stalemate"]:
             return "<h3 style=\"color: blue;\">No legal moves left!  Stalemate</h3>"
         return ""
-
-    # If the king moved two spaces laterally, see if a castling move is possible (first move, no spaces in check, clear)
-    def castle(self) -> str:
-        if not isinstance(self.startSquare.piece, King):
-            return "No king at start square!"
-        if abs(self.startSquare.column - self.endSquare.column) != 2:
-            return "End square input must be either two to the left or right of the king"
-        row = self.endSquare.row
-        if self.endSquare.column <= 3:
-            column = 0
-            columnChange = 3
-        else:
-            column = 7
-            columnChange = -2
-        rookStartSquare = self.board.getSquare(row, column)
-        if not isinstance(rookStartSquare.piece, Rook):
-            return "No rook found for castle move!"
-        self.endSquare.piece = self.startSquare.piece
-        self.startSquare.piece = None
-        self.endSquare.piece.moved = True
-        rookEndSquare = self.board.getSquare(row, column + columnChange)
-        rookEndSquare.piece = rookStartSquare.piece
-        rookStartSquare.piece = None
-        rookEndSquare.piece.moved = True
-        return ""
-
-    # If a pawn moved two spaces, it could still be taken by an opposing pawn diagonally moving to the skipped square
-    def markEnPassant(self):
-        if isinstance(self.startSquare.piece, Pawn) and \
-                abs(self.endSquare.row - self.startSquare.row) == 2:
-            self.startSquare.piece.enPassant = True
-        else:
-            self.startSquare.piece.enPassant = False
-
-    # Check if an en passant move is being attempted (rare)
-    def isEnPassantAttempt(self) -> bool:
-        return isinstance(self.startSquare.piece, Pawn) \
-               and self.endSquare.column != self.startSquare.column and \
-               self.endSquare.piece is None
-
-    # Apply the en passant move only after a thorough check that it is legal
-    def enPassant(self):
-        enPassant = self.board.getSquare(self.startSquare.row, self.endSquare.column)
-        if enPassant.piece is not None and \
-                isinstance(enPassant.piece, Pawn) and \
-                enPassant.piece.player == Square.opponent(self.currentPlayer) and \
-                enPassant.piece.enPassant:
-            self.endSquare.piece = self.startSquare.piece
-            self.startSquare.piece = None
-            enPassant.piece = None
-            return ""
-        else:
-            return "Not a valid en Passant move"
@@ -10,23 +10,19 @@
 import secrets
 from chess import Chess
 from flask import request, url_for
-from board import Square
-from pieces import (
-    BlackBishop,
-    BlackKing,
-    BlackKnight,
-    BlackPawn,
-    BlackQueen,
-    BlackRook,
-    WhiteBishop,
-    WhiteKing,
-    WhiteKnight,
-    WhitePawn,
-    WhiteQueen,
-    WhiteRook,
-)
+from board import Move, Square, castlingFromText, legacyCastling
+from bitboard import indices, squareFromName, squareIndex, squareName
+from pieces import LETTERS_BY_PIECE, PIECES
 from game_store import load_game, save_game
 
+# Layout written by Game.to_state.  Saves without a "format" are the first
+# layout, which from_state still reads
+STATE_FORMAT = 3
+
+# Fields of the saved state that only change outside of moves
+STATE_DETAILS = ("format", "game_code", "player_1_code", "player_2_code", "host_player",
+                 "guest_code_claimed", "game_on", "pending_promotion")
+
 
 class Game(object):
 
@@ -38,6 +34,13 @@ class Game(object):
     guestPlayer: int
     version: int
     guestCodeClaimed: bool
+    # Saves write each move to a log, and the full state only now and then,
+    # so the game remembers how much of itself has been saved:
+    basePly: int  # plies played before the first move in the board's history
+    loggedMoves: int  # moves in the board's history that are in the log
+    snapshotPly: int  # ply at which the full state was last saved
+    savedDetails: dict  # STATE_DETAILS as they were last saved
+    savedTurn: tuple  # ply and pending promotion as they were last saved
 
     def __init__(self, gamecode: int):
         if gamecode is None:
@@ -47,9 +50,24 @@ class Game(object):
             self.chess_game = Chess()
             self.version = 0
             self.guestCodeClaimed = False
+            self.basePly = 0
+            self.loggedMoves = 0
+            self.snapshotPly = 0
+            self.savedDetails = None
+            self.savedTurn = None
+
+    # A new game (with new codes) that starts from the position in a FEN string
+    @classmethod
+    def from_fen(cls, fen: str) -> "Game":
+        game = cls(None)
+        game.chess_game = Chess.fromFEN(fen)
+        return game
 
+    # Rebuild a game from its last full state and the moves logged after it,
+    # each given as (from square, to square, promotion), along with the
+    # position_status saved with the latest of them, if there is one
     @classmethod
-    def from_state(cls, state: dict, version: int) -> "Game":
+    def from_state(cls, state: dict, version: int, moves=(), status: dict = None) -> "Game":
         game = cls.__new__(cls)
         game.gamecode = state["game_code"]
         game.player1code = state["player_1_code"]
@@ -57,75 +75,147 @@ class Game(object):
         game.hostPlayer = state["host_player"]
         game.guestCodeClaimed = state.get("guest_code_claimed", False)
         game.version = version
-        game.chess_game = Chess()
-        board = game.chess_game.board
+        state_format = state.get("format", 1)
+        pending_promotion = state.get("pending_promotion")
+        if state_format in (2, 3):
+            # The position is stored in FEN (early saves of format 2 leave off
+            # the move counters)
+            game.chess_game = Chess.fromFEN(state["position"])
+        elif state_format == 1:
+            game._board_from_state(state)
+            if pending_promotion is not None:
+                pending_promotion = squareName(squareIndex(*pending_promotion))
+        else:
+            raise ValueError("Saved game is in an unknown format")
+        game.chess_game.gameOn = state["game_on"]
+        game.basePly = game.snapshotPly = state.get("ply", 0)
+        game.savedDetails = {key: state.get(key) for key in STATE_DETAILS}
+
+        chess = game.chess_game
+        for start, end, promotion in moves:
+            chess.board.make_move(Move(start, end, promotion))
+            chess.switchPlayers()
+        game.loggedMoves = len(moves)
+        if pending_promotion is not None:
+            # From format 3 on, a pawn waiting to be promoted is saved as the
+            # move it made (i.e.: "e7e8"), and played again here
+            if len(pending_promotion) == 4:
+                chess.startSquare = chess.board.squares[squareFromName(pending_promotion[:2])]
+                chess.endSquare = chess.board.squares[squareFromName(pending_promotion[2:])]
+                chess.board.make_move(Move(chess.startSquare.index, chess.endSquare.index))
+            else:
+                chess.endSquare = chess.board.squares[squareFromName(pending_promotion)]
+        elif status is not None:
+            chess.seedPositionInfo(status)
+        game.savedTurn = (game.ply(), pending_promotion)
+        return game
+
+    # The first format: an 8x8 list of pieces, each {"type", "player"}
+    def _board_from_state(self, state: dict):
+        self.chess_game = Chess(False)
+        board = self.chess_game.board
         for row, serialized_row in enumerate(state["board"]):
             for column, serialized_piece in enumerate(serialized_row):
                 square = board.getSquare(row, column)
-                square.piece = game._piece_from_state(serialized_piece)
-                if isinstance(square.piece, (WhiteKing, BlackKing)):
-                    if square.piece.player == 1:
-                        board.king1 = square.piece
-                    else:
-                        board.king2 = square.piece
-                    square.piece.location = square
-        game.chess_game.currentPlayer = state["current_player"]
-        game.chess_game.gameOn = state["game_on"]
-        pending_promotion = state.get("pending_promotion")
-        if pending_promotion is not None:
-            game.chess_game.endSquare = board.getSquare(*pending_promotion)
+                square.piece = self._piece_from_state(serialized_piece)
+                # Older saves flag the pawn that just moved two squares instead
+                if serialized_piece is not None and serialized_piece.get("en_passant") and \
+                        serialized_piece["player"] != state["current_player"]:
+                    board.enPassant = square.index - 8 if serialized_piece["player"] == 1 else square.index + 8
+        if state.get("en_passant") is not None:
+            board.enPassant = board.getSquare(*state["en_passant"]).index
+        # ...and keep a "moved" flag on each piece rather than castling rights
+        if "castling" in state:
+            board.castling = castlingFromText(state["castling"])
+        else:
+            board.castling = legacyCastling(state["board"])
+        self.chess_game.currentPlayer = state["current_player"]
+
+    # Copy that can be played on without changing this game
+    def clone(self) -> "Game":
+        game = Game.__new__(Game)
+        game.__dict__.update(self.__dict__)
+        game.chess_game = self.chess_game.clone()
         return game
 
+    # The move of a pawn that is waiting for its promotion to be chosen, if it
+    # is still in the board's history.  It is not saved as a move until then
+    def _pending_move(self) -> Move:
+        chess = self.chess_game
+        if getattr(chess, "endSquare", None) is None or not chess.promotePawnCheck():
+            return None
+        history = chess.board.history
+        if history and history[-1].move.end == chess.endSquare.index and history[-1].move.promotion is None:
+            return history[-1].move
+        return None
+
+    # Number of plies played, not counting a pawn waiting for its promotion
+    def ply(self) -> int:
+        played = len(self.chess_game.board.history)
+        if self._pending_move() is not None:
+            played -= 1
+        return self.basePly + played
+
+    # Moves that are not in the log yet, as (ply, move)
+    def unsaved_moves(self) -> list:
+        history = self.chess_game.board.history
+        played = self.ply() - self.basePly
+        return [(self.basePly + index + 1, history[index].move)
+                for index in range(self.loggedMoves, played)]
+
+    # Whether the full state has to be written with the next save: when any
+    # of its details have changed (which the move log cannot show), or once
+    # enough moves have been logged since it was last written
+    def needs_snapshot(self, state: dict, interval: int) -> bool:
+        if {key: state.get(key) for key in STATE_DETAILS} != self.savedDetails:
+            return True
+        return state["ply"] - self.snapshotPly >= interval
+
+    # Whether a move was made or a pawn promoted since the last save (rather
+    # than only a detail changing, i.e.: the guest claiming their code)
+    def moved_since_saved(self, state: dict) -> bool:
+        return (state["ply"], state["pending_promotion"]) != self.savedTurn
+
+    # Record what a successful save wrote
+    def mark_saved(self, state: dict, snapshot: bool):
+        self.loggedMoves = state["ply"] - self.basePly
+        self.savedTurn = (state["ply"], state["pending_promotion"])
+        if snapshot:
+            self.snapshotPly = state["ply"]
+            self.savedDetails = {key: state.get(key) for key in STATE_DETAILS}
+
     def to_state(self) -> dict:
-        board = self.chess_game.board
+        chess = self.chess_game
         pending_promotion = None
-        end_square = getattr(self.chess_game, "endSquare", None)
-        if end_square is not None and self.chess_game.promotePawnCheck():
-            pending_promotion = [end_square.row, end_square.column]
+        pending_move = self._pending_move()
+        if pending_move is not None:
+            # Saved from before the pawn moved, with the move kept aside
+            chess = chess.clone()
+            chess.board.unmake_move()
+            pending_promotion = str(pending_move)
+        elif getattr(chess, "endSquare", None) is not None and chess.promotePawnCheck():
+            pending_promotion = squareName(chess.endSquare.index)
         return {
+            "format": STATE_FORMAT,
             "game_code": self.gamecode,
             "player_1_code": self.player1code,
             "player_2_code": self.player2code,
             "host_player": self.hostPlayer,
             "guest_code_claimed": self.guestCodeClaimed,
-            "current_player": self.chess_game.currentPlayer,
-            "game_on": self.chess_game.gameOn,
+            "game_on": chess.gameOn,
             "pending_promotion": pending_promotion,
-            "board": [
-                [self._piece_to_state(square.piece) for square in row]
-                for row in board.grid
-            ],
+            "ply": self.ply(),
+            "position": chess.toFEN(),
         }
 
-    @staticmethod
-    def _piece_to_state(piece):
-        if piece is None:
-            return None
-        state = {"type": piece.name, "player": piece.player, "moved": piece.moved}
-        if isinstance(piece, (WhitePawn, BlackPawn)):
-            state["en_passant"] = piece.enPassant
-        return state
-
     @staticmethod
     def _piece_from_state(state):
         if state is None:
             return None
-        piece_classes = {
-            ("pawn", 1): WhitePawn, ("pawn", 2): BlackPawn,
-            ("knight", 1): WhiteKnight, ("knight", 2): BlackKnight,
-            ("bishop", 1): WhiteBishop, ("bishop", 2): BlackBishop,
-            ("rook", 1): WhiteRook, ("rook", 2): BlackRook,
-            ("queen", 1): WhiteQueen, ("queen", 2): BlackQueen,
-            ("king", 1): WhiteKing, ("king", 2): BlackKing,
-        }
         try:
-            piece = piece_classes[(state["type"], state["player"])]()
+            return PIECES[(state["type"], state["player"])]
         except KeyError as error:
             raise ValueError("Saved game contains an invalid piece") from error
-        piece.moved = state["moved"]
-        if isinstance(piece, (WhitePawn, BlackPawn)):
-            piece.enPassant = state.get("en_passant", False)
-        return piece
 
     def setHostPlayer(self, player: int):
         self.hostPlayer = player
@@ -141,9 +231,76 @@ class Game(object):
         else:
             raise Exception("Player must be 1 or 2")
 
-    # Main gameplay function (heart of program)
-    def chess_page(self, player_code: int) -> str:
-        # Save game as a file on the server (as a JSON pickle)
+    # The player (1 or 2) a player code belongs to, or None
+    def getPlayer(self, player_code: int) -> int:
+        if self.player1code == player_code:
+            return 1
+        elif self.player2code == player_code:
+            return 2
+        return None
+
+    # Whether the last move brought a pawn to the far side, and the player has
+    # yet to choose what it becomes
+    def awaiting_promotion(self) -> bool:
+        chess = self.chess_game
+        return getattr(chess, "endSquare", None) is not None and chess.promotePawnCheck()
+
+    # Where the game stands for one player, as sent by the JSON API
+    def status(self, player: int) -> dict:
+        chess = self.chess_game
+        promotion = self.awaiting_promotion()
+        # The moves looked up for the side to move would be its next ones
+        # while a pawn is still waiting to be promoted
+        info = chess.positionInfo() if not promotion else {"check": False, "checkmate": False, "stalemate": False}
+        return {
+            "version": self.version,
+            "player": player,
+            "turn": chess.currentPlayer,
+            "game_on": chess.gameOn,
+            "check": info["check"],
+            "checkmate": info["checkmate"],
+            "stalemate": info["stalemate"],
+            "promotion": promotion,
+            "moves": self.legal_moves(player),
+        }
+
+    # Check, checkmate, stalemate, the legal moves of the side to move and
+    # those that would leave its king in check, as saved with each move so
+    # that loading the game does not work them out again.  None while a pawn is waiting to be promoted, since the side to
+    # move has not changed yet
+    def position_status(self) -> dict:
+        if self.awaiting_promotion():
+            return None
+        chess = self.chess_game
+        info = chess.positionInfo()
+        return {
+            "check": info["check"],
+            "checkmate": info["checkmate"],
+            "stalemate": info["stalemate"],
+            "moves": list(chess.legalMoveCodes()),
+            "checked": list(chess.checkedMoveNames()),
+        }
+
+    # Legal moves for the player, as text like "e2e4", if it is their turn
+    def legal_moves(self, player: int) -> list:
+        chess = self.chess_game
+        if player != chess.currentPlayer or not chess.gameOn or self.awaiting_promotion():
+            return []
+        return list(chess.legalMoveNames())
+
+    # Squares that have changed since the board's mailbox was copied, as
+    # {square: FEN letter of the piece now on it, or None if it is empty}
+    def changed_squares(self, before: list) -> dict:
+        mailbox = self.chess_game.board.mailbox
+        return {squareName(index): LETTERS_BY_PIECE.get(mailbox[index])
+                for index in range(64) if mailbox[index] is not before[index]}
+
+    # Main gameplay function (heart of program): play the turn submitted with
+    # the page's form (or a dict of the same fields), if it is this player's.
+    # Returns whether the game needs saving, and what the page should show
+    def take_turn(self, player_code: int, form=None) -> tuple:
+        if form is None:
+            form = request.form
 
         # Set all initial values to their default
         error = ""
@@ -155,11 +312,8 @@ class Game(object):
         awaiting_turn = "0"
         should_save = False
 
-        if self.player1code == player_code:
-            player = 1
-        elif self.player2code == player_code:
-            player = 2
-        else:
+        player = self.getPlayer(player_code)
+        if player is None:
             raise Exception("No valid player code was submitted")
 
         # If it's my turn...
@@ -167,11 +321,12 @@ class Game(object):
 
             # Check to see if pawn reached the other side in the last move
             # and change the piece to the player's choice
-            if request.form.get("promotion") == "1":
-                promotion_choice = request.form.get("promotion_pieces")
+            if form.get("promotion") == "1":
+                promotion_choice = form.get("promotion_pieces")
                 error = self.chess_game.promotePawn(promotion_choice)
                 if not error:
                     self.chess_game.switchPlayers()
+                    self.chess_game.updateGameOn()
                     awaiting_turn = "1"
                     should_save = True
                 else:
@@ -181,10 +336,10 @@ class Game(object):
                     disabled_input = " disabled"
 
             # If this was a normal move...
-            elif ((request.form.get("next_move_start") is not None) and (
-                    request.form.get("next_move_start") is not None)):
-                next_move_start = request.form.get("next_move_start")
-                next_move_end = request.form.get("next_move_end")
+            elif ((form.get("next_move_start") is not None) and (
+                    form.get("next_move_start") is not None)):
+                next_move_start = form.get("next_move_start")
+                next_move_end = form.get("next_move_end")
                 error = self.chess_game.movePiece(next_move_start, next_move_end, player)
 
                 # If there were no problems with the move...
@@ -201,16 +356,47 @@ class Game(object):
                     # End move if not a promotion
                     else:
                         self.chess_game.switchPlayers()
+                        self.chess_game.updateGameOn()
                     should_save = True
 
-        # Check for end of game, save game, and display appropriate board to user
-        game_was_on = self.chess_game.gameOn
+        # Display the end of the game (found when the last move was played)
+        # and the appropriate board to the user
         game_status = self.chess_game.gameStatus(player)
         if not self.chess_game.gameOn:
             disabled_input = " disabled"
             disabled_submit = " disabled"
-        if should_save or game_was_on != self.chess_game.gameOn:
+        view = {
+            "player": player,
+            "error": error,
+            "disabled_input": disabled_input,
+            "disabled_submit": disabled_submit,
+            "pawn_label_hidden": pawn_label_hidden,
+            "pawn_dialog_hidden": pawn_dialog_hidden,
+            "promotion": promotion,
+            "awaiting_turn": awaiting_turn,
+            "game_status": game_status,
+        }
+        return should_save, view
+
+    # Play the submitted turn, save the game if that changed it, and show it
+    def chess_page(self, player_code: int) -> str:
+        should_save, view = self.take_turn(player_code)
+        if should_save:
             save_game(self)
+        return self.render_page(view)
+
+    # The page for the player in the view returned by take_turn
+    def render_page(self, view: dict) -> str:
+        player = view["player"]
+        player_code = self.getPlayerCode(player)
+        error = view["error"]
+        disabled_input = view["disabled_input"]
+        disabled_submit = view["disabled_submit"]
+        pawn_label_hidden = view["pawn_label_hidden"]
+        pawn_dialog_hidden = view["pawn_dialog_hidden"]
+        promotion = view["promotion"]
+        awaiting_turn = view["awaiting_turn"]
+        game_status = view["game_status"]
         output = self.chess_game.drawBoard(player)
         if not self.chess_game.gameOn:
             header_text = "Game over!"
@@ -221,6 +407,13 @@ class Game(object):
             awaiting_turn = "1"
             disabled_input = " disabled"
             disabled_submit = " disabled"
+        legal_moves = " ".join(self.legal_moves(player)) if not disabled_input else ""
+        # Along with the player's squares and the moves that would leave their
+        # king in check, so the page can turn a move down with movePiece's words
+        own_squares = checked_moves = ""
+        if legal_moves:
+            own_squares = " ".join(squareName(index) for index in indices(self.chess_game.board.occupied[player]))
+            checked_moves = " ".join(self.chess_game.checkedMoveNames())
         return '''
     <!DOCTYPE html>
     <html>
@@ -268,6 +461,7 @@ class Game(object):
                 .board {{ white-space: pre; font-family: monospace, monospace; font-size: small; margin: 0; line-height: 1.1; }}
                 .error {{ color: #a52d2d; }}
                 .gameStatus {{ color: #286548; }}
+                .target {{ box-shadow: inset 0 0 0 3px #286548; }}
                 .white {{ display: inline-block; width: 25px; height: 25px; line-height: 25px; text-align: center; font-size: 20px; background-color: white; }}
                 .black {{ display: inline-block; width: 25px; height: 25px; line-height: 25px; text-align: center; font-size: 20px; background-color: darkgray; }}
                 .toplabel {{ border-bottom: 1px solid black; }}
@@ -293,26 +487,104 @@ class Game(object):
                     return new Promise(resolve => setTimeout(resolve, ms));
                 }}
 
+                // Ask the server for the saved version of the game.  The request is held
+                // open until the opponent saves a move (or times out and is sent again),
+                // and the whole page is only reloaded once the version has changed
                 async function awaitingTurn() {{
                     if (document.getElementById("awaiting_turn").value == "1")
                     {{
-                        await sleep(5000);
                         var game_code = document.getElementById("game_code").value;
                         var player_code = document.getElementById("player_code").value;
+                        var version = document.getElementById("version").value;
+                        while (true) {{
+                            try {{
+                                var response = await fetch("{version_url}?game=" + game_code + "&since=" + version,
+                                                           {{cache: "no-store"}});
+                                if (!response.ok) {{
+                                    await sleep(5000);
+                                }} else if (String((await response.json()).version) != version) {{
+                                    break;
+                                }}
+                            }} catch (error) {{
+                                // Back off through network hiccups
+                                await sleep(5000);
+                            }}
+                        }}
                         window.location.href = window.location.pathname + "?game=" + game_code + "&player=" + player_code;
                     }}
                 }}
+
+                // The legal moves (i.e.: "e2e4") come with the page when it is this
+                // player's turn, so a move can be checked without asking the server
+                function legalMoves() {{
+                    var text = document.getElementById("legal_moves").value;
+                    return text ? text.split(" ") : null;
+                }}
+
+                // The board's div for a square such as "e4".  The board is a row of
+                // letters, then each row as a number, its 8 squares and the number again
+                function boardSquare(name) {{
+                    var divs = document.querySelectorAll(".board div");
+                    var whiteSide = divs[1].textContent == "a";
+                    var column = name.charCodeAt(0) - "a".charCodeAt(0);
+                    var row = Number(name[1]) - 1;
+                    return divs[10 + (whiteSide ? 7 - row : row) * 10 + (whiteSide ? column : 7 - column)];
+                }}
+
+                // Outline the squares the chosen piece can move to
+                function showTargets() {{
+                    document.querySelectorAll(".board .target").forEach(square => square.classList.remove("target"));
+                    var moves = legalMoves();
+                    var start = document.getElementById("next_move_start").value.toLowerCase();
+                    if (moves !== null && /^[a-h][1-8]$/.test(start)) {{
+                        moves.filter(move => move.startsWith(start))
+                             .forEach(move => boardSquare(move.slice(2)).classList.add("target"));
+                    }}
+                }}
+
+                // Turn down a move that is not in the list before it is sent, with
+                // the message the server would give
+                function checkMove(event) {{
+                    var moves = legalMoves();
+                    if (moves === null) {{
+                        return;
+                    }}
+                    var ownSquares = document.getElementById("own_squares").value.split(" ");
+                    var checkedMoves = document.getElementById("checked_moves").value.split(" ");
+                    var start = document.getElementById("next_move_start").value.toLowerCase();
+                    var end = document.getElementById("next_move_end").value.toLowerCase();
+                    var error = "";
+                    if (!/^[a-h][1-8]$/.test(start) || !/^[a-h][1-8]$/.test(end)) {{
+                        error = "Please type column letter then row number";
+                    }} else if (!ownSquares.includes(start)) {{
+                        error = "Please choose your own piece";
+                    }} else if (ownSquares.includes(end)) {{
+                        error = "Please move to an empty square or capture a piece";
+                    }} else if (checkedMoves.includes(start + end)) {{
+                        error = "This move places you in check, please try again";
+                    }} else if (!moves.includes(start + end)) {{
+                        error = "Move is illegal";
+                    }}
+                    if (error) {{
+                        event.preventDefault();
+                        document.getElementById("error").textContent = error;
+                    }}
+                }}
             </script>
         </head>
         <body onload = "awaitingTurn();">
-            <form id="move_form" method="post" action=".">
+            <form id="move_form" method="post" action="." onsubmit="checkMove(event);">
                 <h3>{header_text}</h3>
                 <input type="hidden" name="form_type" id="form_type" value="move" />
                 <input type="hidden" name="game_code" id="game_code" value={game_code} />
                 <input type="hidden" name="player_code" id="player_code" value={player_code} />
                 <input type="hidden" name="awaiting_turn" id="awaiting_turn" value={awaiting_turn} />
+                <input type="hidden" name="version" id="version" value={version} />
+                <input type="hidden" id="legal_moves" value="{legal_moves}" />
+                <input type="hidden" id="own_squares" value="{own_squares}" />
+                <input type="hidden" id="checked_moves" value="{checked_moves}" />
                 <div class="board">{output}</div>
-                <h3 class="error">{error}</h3>
+                <h3 class="error" id="error">{error}</h3>
                 <label for="promotion_pieces" id="promotion_pieces_label"{pawn_label_hidden}>Pick a piece to promote your \
                 pawn to!</label>
                 <select name="promotion_pieces" id="promotion_pieces"{pawn_dialog_hidden}>
@@ -324,7 +596,7 @@ class Game(object):
                 <input type="hidden" name="promotion" value={promotion} />
                 <h3 class="gameStatus">{game_status}</h3>
                 <label for="next_move_start">Select piece to move:</label>
-                <input type="text" id="next_move_start" name="next_move_start" {disabled_input2} \
+                <input type="text" id="next_move_start" name="next_move_start" oninput="showTargets();" {disabled_input2} \
                 autofocus/>
                 <br>
                 <label for="next_move_end">Select square to move to:</label>
@@ -334,6 +606,8 @@ class Game(object):
        </body>
     </html>
         '''.format(game_code=self.gamecode, player_code=player_code, awaiting_turn=awaiting_turn, output=output, error=error,
+                   version=self.version, version_url=url_for('game_version'), legal_moves=legal_moves,
+                   own_squares=own_squares, checked_moves=checked_moves,
                    pawn_label_hidden=pawn_label_hidden, pawn_dialog_hidden=pawn_dialog_hidden, promotion=promotion,
                    game_status=game_status, disabled_input1=disabled_input, disabled_input2=disabled_input,
                    disabled_submit=disabled_submit, favicon_32=url_for('static', filename='favicon-32x32.png'),
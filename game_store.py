@@ -1,10 +1,11 @@
+import importlib
 import json
 import os
+import threading
+import time
 from typing import TYPE_CHECKING
 
-import psycopg
-from psycopg.errors import UniqueViolation
-from psycopg.types.json import Jsonb
+from lru import LRUCache
 
 if TYPE_CHECKING:
     from game import Game
@@ -22,78 +23,256 @@ class GameVersionConflict(GameStoreError):
     pass
 
 
-SCHEMA = """
-CREATE TABLE IF NOT EXISTS chess_games (
-    game_code INTEGER PRIMARY KEY,
-    state JSONB NOT NULL,
-    version INTEGER NOT NULL DEFAULT 0,
-    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-)
-"""
+# Where games are kept, chosen with GAME_STORE.  Each backend is a module with
+# the same functions: transaction(write) opens a transaction and yields a
+# handle, which insert_game, read_game, write_game, read_moves and
+# read_version work within; migrate() and wait_for_version() stand alone.
+# Alongside its state, each game keeps the position_status of its latest
+# move, rewritten with every save
+STORES = {
+    "postgres": "store_postgres",  # PostgreSQL at DATABASE_URL
+    "sqlite": "store_sqlite",  # one SQLite file (SQLITE_PATH), for a single machine
+    "memory": "store_memory",  # kept by the process itself, for tests and benchmarks
+}
 
+_store = None
 
-def _connect():
-    database_url = os.environ.get("DATABASE_URL")
-    if not database_url:
-        raise GameStoreError("DATABASE_URL must be configured")
-    return psycopg.connect(database_url)
 
+def _get_store():
+    global _store
+    if _store is None:
+        name = os.environ.get("GAME_STORE") or "postgres"
+        if name not in STORES:
+            raise GameStoreError(f"GAME_STORE must be one of {', '.join(STORES)}")
+        _store = importlib.import_module(STORES[name])
+    return _store
 
-def _ensure_schema(connection):
-    with connection.cursor() as cursor:
-        cursor.execute(SCHEMA)
+
+# The full state is saved at least once every this many plies (and whenever
+# something other than a move changes); loads replay the moves logged since
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", "20"))
+
+# Times apply_move reloads and plays a move again after losing a race with a
+# write that did not move any pieces
+APPLY_MOVE_ATTEMPTS = int(os.environ.get("APPLY_MOVE_ATTEMPTS", "3"))
+
+
+# Bring the backend's schema up to date, returning the version it ends up at
+def run_migrations() -> int:
+    return _get_store().migrate()
 
 
 def create_game(game: "Game") -> bool:
-    try:
-        with _connect() as connection:
-            _ensure_schema(connection)
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO chess_games (game_code, state) VALUES (%s, %s)",
-                    (game.gamecode, Jsonb(game.to_state())),
-                )
-        game.version = 0
-        return True
-    except UniqueViolation:
+    store = _get_store()
+    state = game.to_state()
+    with store.transaction() as handle:
+        created = store.insert_game(handle, game.gamecode, state, state["ply"], game.position_status())
+    if not created:
         return False
+    game.version = 0
+    game.mark_saved(state, True)
+    _game_cache.put(game.gamecode, (game.version, game.clone()))
+    return True
+
+
+# Log the moves played since the last save and bump the version, writing the
+# full state as well only when the game asks for a snapshot.  Returns what
+# was written for _mark_written, or None if the game changed in the meantime
+def _write_game(store, handle, game: "Game"):
+    state = game.to_state()
+    snapshot = game.needs_snapshot(state, SNAPSHOT_INTERVAL)
+    version = store.write_game(
+        handle,
+        game.gamecode,
+        game.version,
+        state if snapshot else None,
+        state["ply"],
+        game.moved_since_saved(state),
+        [(ply, move.start, move.end, move.promotion) for ply, move in game.unsaved_moves()],
+        game.position_status(),
+    )
+    if version is None:
+        _game_cache.discard(game.gamecode)
+        return None
+    return version, state, snapshot
+
+
+# Bring the game up to date with a write once it has been committed (and not
+# before, so the cache never holds a version the database might not reach)
+def _mark_written(game: "Game", written) -> None:
+    version, state, snapshot = written
+    game.version = version
+    game.mark_saved(state, snapshot)
+    _game_cache.put(game.gamecode, (game.version, game.clone()))
 
 
 def save_game(game: "Game") -> None:
-    with _connect() as connection:
-        _ensure_schema(connection)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                """
-                UPDATE chess_games
-                SET state = %s, version = version + 1, updated_at = NOW()
-                WHERE game_code = %s AND version = %s
-                RETURNING version
-                """,
-                (Jsonb(game.to_state()), game.gamecode, game.version),
-            )
-            row = cursor.fetchone()
-    if row is None:
+    store = _get_store()
+    with store.transaction() as handle:
+        written = _write_game(store, handle, game)
+    if written is None:
         raise GameVersionConflict("The game changed before this request could be saved")
-    game.version = row[0]
+    _mark_written(game, written)
 
 
-def load_game(game_code: int) -> "Game":
-    with _connect() as connection:
-        _ensure_schema(connection)
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT state, version FROM chess_games WHERE game_code = %s",
-                (game_code,),
-            )
-            row = cursor.fetchone()
+# Every move of a game in order, as (ply, Move), for replays and analysis
+def load_moves(game_code: int) -> list:
+    store = _get_store()
+    with store.transaction(write=False) as handle:
+        rows = store.read_moves(handle, game_code)
+    from board import Move
+
+    return [(ply, Move(start, end, promotion)) for ply, start, end, promotion in rows]
+
+
+# Only the version number of a saved game, which changes with every save.
+# Cheap enough to poll, since the state itself is never read
+def load_version(game_code: int) -> int:
+    store = _get_store()
+    with store.transaction(write=False) as handle:
+        version = store.read_version(handle, game_code)
+    if version is None:
+        raise GameNotFound("No saved game found")
+    return version
+
+
+# Wakes up the requests waiting on games as the backend hears about saves.
+# Backends that only hear about their own process's saves pass a poll
+# interval, so waiting requests also look the version up every so often
+class VersionWaiter:
+
+    def __init__(self, poll: float = None):
+        self.poll = poll
+        self.condition = threading.Condition()
+        self.waiting = {}  # game code -> number of requests waiting on it
+        self.versions = {}  # game code -> newest version heard, for waited-on games only
+
+    # Seconds between version lookups while waiting, or None to rely on what
+    # is heard alone.  Checked again after every lookup
+    def poll_interval(self):
+        return self.poll
+
+    def heard(self, game_code: int, version: int):
+        with self.condition:
+            if game_code in self.waiting and version > self.versions.get(game_code, -1):
+                self.versions[game_code] = version
+                self.condition.notify_all()
+
+    def wait(self, game_code: int, since: int, timeout: float) -> int:
+        # Register the wait before looking the version up, so a save in
+        # between is still heard (as long as the backend is hearing saves at
+        # all, which is what the poll interval is for)
+        with self.condition:
+            self.waiting[game_code] = self.waiting.get(game_code, 0) + 1
+        try:
+            version = load_version(game_code)
+            if version > since:
+                return version
+            deadline = time.monotonic() + timeout
+            while True:
+                poll = self.poll_interval()
+                until = deadline if poll is None else min(deadline, time.monotonic() + poll)
+                with self.condition:
+                    while self.versions.get(game_code, -1) <= since:
+                        remaining = until - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    heard = self.versions.get(game_code, -1)
+                if heard > since:
+                    return heard
+                version = load_version(game_code)
+                if version > since or time.monotonic() >= deadline:
+                    return version
+        finally:
+            with self.condition:
+                self.waiting[game_code] -= 1
+                if not self.waiting[game_code]:
+                    del self.waiting[game_code]
+                    self.versions.pop(game_code, None)
+
+
+# Block until the game has been saved past the given version (returning the
+# new version straight away), or until the timeout runs out (returning the
+# version as it stands)
+def wait_for_version(game_code: int, since: int, timeout: float) -> int:
+    return _get_store().wait_for_version(game_code, since, timeout)
+
+
+# Hydrated games by game code, as (version, Game).  The cached game is never
+# handed out itself, only clones of it, so a request that changes its game but
+# fails to save cannot leave a bad copy behind
+_game_cache = LRUCache(int(os.environ.get("GAME_CACHE_SIZE", "128")))
+
+
+def game_cache_stats() -> dict:
+    return _game_cache.stats()
+
+
+# The game as saved, and the version at which its last move was made.  The
+# backend gives back (state, version, moves, position version, status),
+# leaving out the state, moves and status when the version is the cached one
+def _read_game(store, handle, game_code: int) -> tuple:
+    cached = _game_cache.peek(game_code)
+    cached_version = cached[0] if cached is not None else None
+    row = store.read_game(handle, game_code, cached_version)
+    if row is not None:
+        cached = _game_cache.get(game_code, lambda entry: entry[0] == row[1])
+        if cached is not None:
+            return cached[1].clone(), row[3]
+        if row[0] is None:
+            # Pushed out of the cache since it was looked at
+            row = store.read_game(handle, game_code, None)
     if row is None:
+        _game_cache.discard(game_code)
         raise GameNotFound("No saved game found")
 
-    state, version = row
+    state, version, moves, position_version, status = row
     if isinstance(state, str):
         state = json.loads(state)
+    if isinstance(moves, str):
+        moves = json.loads(moves)
+    if isinstance(status, str):
+        status = json.loads(status)
     from game import Game
 
-    return Game.from_state(state, version)
\ No newline at end of file
+    game = Game.from_state(state, version, moves or (), status)
+    _game_cache.put(game_code, (version, game.clone()))
+    return game, position_version
+
+
+def load_game(game_code: int) -> "Game":
+    store = _get_store()
+    with store.transaction(write=False) as handle:
+        return _read_game(store, handle, game_code)[0]
+
+
+# Load a game, play a move on it and save it, all in one transaction.
+# mutate_fn is given the game and returns (whether to save it, result).  The
+# player saw the game at expected_version (None skips the check): if a move
+# has been made since, that is a conflict, but if the game only changed in
+# some other way (i.e.: the guest claiming their code) the move is played on
+# the newer game instead.  Losing the race to save is retried the same way, up
+# to APPLY_MOVE_ATTEMPTS times.  Returns the game and mutate_fn's result
+def apply_move(game_code: int, expected_version, mutate_fn) -> tuple:
+    store = _get_store()
+    written = None
+    with store.transaction() as handle:
+        for _ in range(APPLY_MOVE_ATTEMPTS):
+            game, position_version = _read_game(store, handle, game_code)
+            if expected_version is not None and position_version > expected_version:
+                raise GameVersionConflict("A move was made in this game since the page was loaded")
+            should_save, result = mutate_fn(game)
+            if not should_save:
+                return game, result
+            written = _write_game(store, handle, game)
+            if written is not None:
+                break
+    if written is None:
+        raise GameVersionConflict("The game changed before this request could be saved")
+    _mark_written(game, written)
+    return game, result
+
+
+if __name__ == "__main__":
+    print(f"Database schema is at version {run_migrations()}")
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+# A small thread-safe least-recently-used cache with hit and miss counters
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    maxSize: int
+    hits: int
+    misses: int
+
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    # Look up a key, marking it as recently used (None if it is not cached).
+    # An entry that fails the optional valid() test counts as a miss
+    def get(self, key, valid=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if valid is not None and not valid(value):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Look up a key without counting it or changing its place in line
+    def peek(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    # Store a value, pushing out the least recently used entry when full
+    def put(self, key, value):
+        if self.maxSize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "max_size": self.maxSize,
+                "hits": self.hits, "misses": self.misses}
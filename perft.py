@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# Perft: count every position reachable to a given depth and compare the totals
+# with published figures.  This is both the benchmark for move generation speed
+# and a check that castling, en passant, promotion and pins are still handled
+# correctly.  Run "python3 perft.py --help" for options; the exit status is 1
+# if any count is wrong
+
+import argparse
+import sys
+import time
+
+from board import Board
+from chess import Chess
+
+# Well known test positions and their node counts at depth 1, 2, 3...
+POSITIONS = {
+    "start": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+              [20, 400, 8902, 197281, 4865609]),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 [48, 2039, 97862, 4085603]),
+    "endgame": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                [14, 191, 2812, 43238, 674624]),
+    "promotion": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  [6, 264, 9467, 422333]),
+    "castling": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                 [44, 1486, 62379, 2103487]),
+    "middlegame": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                   [46, 2079, 89890, 3894594]),
+}
+
+# Set up a board from a FEN string, returning the board and the player to move
+def setupPosition(fen: str) -> tuple:
+    chess = Chess.fromFEN(fen)
+    return chess.board, chess.currentPlayer
+
+
+# Count the leaf nodes of the move tree to the given depth
+def perft(board: Board, player: int, depth: int) -> int:
+    moves = list(board.generate_legal_moves(player))
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    otherPlayer = 3 - player
+    for move in moves:
+        board.make_move(move)
+        nodes += perft(board, otherPlayer, depth - 1)
+        board.unmake_move()
+    return nodes
+
+
+# Node count below each legal move, for tracking down a wrong total
+def divide(board: Board, player: int, depth: int) -> dict:
+    counts = {}
+    for move in list(board.generate_legal_moves(player)):
+        board.make_move(move)
+        counts[str(move)] = perft(board, 3 - player, depth - 1)
+        board.unmake_move()
+    return counts
+
+
+def main(arguments=None) -> int:
+    parser = argparse.ArgumentParser(description="Count move generation nodes and check them against known totals")
+    parser.add_argument("--depth", type=int, default=3, help="deepest level to count (default 3)")
+    parser.add_argument("--position", choices=sorted(POSITIONS), action="append",
+                        help="known position to run (default: all of them)")
+    parser.add_argument("--fen", help="run a custom position instead (no expected totals)")
+    parser.add_argument("--divide", action="store_true", help="show the count below each first move")
+    options = parser.parse_args(arguments)
+
+    if options.fen:
+        runs = [("fen", options.fen, [])]
+    else:
+        runs = [(name, *POSITIONS[name]) for name in options.position or POSITIONS]
+
+    failures = 0
+    totalNodes = 0
+    totalTime = 0.0
+    for name, fen, expected in runs:
+        for depth in range(1, options.depth + 1):
+            if expected and depth > len(expected):
+                break
+            board, player = setupPosition(fen)
+            started = time.perf_counter()
+            nodes = perft(board, player, depth)
+            elapsed = time.perf_counter() - started
+            totalNodes += nodes
+            totalTime += elapsed
+            if not expected:
+                result = ""
+            elif nodes == expected[depth - 1]:
+                result = "ok"
+            else:
+                result = "FAILED (expected {})".format(expected[depth - 1])
+                failures += 1
+            print("{:<11} depth {}  {:>10} nodes  {:>8.3f}s  {:>9.0f} nodes/s  {}".format(
+                name, depth, nodes, elapsed, nodes / elapsed if elapsed else 0, result))
+        if options.divide:
+            board, player = setupPosition(fen)
+            for move, nodes in sorted(divide(board, player, options.depth).items()):
+                print("    {}: {}".format(move, nodes))
+    if totalTime:
+        print("total {} nodes in {:.3f}s ({:.0f} nodes/s)".format(totalNodes, totalTime, totalNodes / totalTime))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,61 +9,79 @@
 from piecetypes import Pawn, Knight, Bishop, Rook, Queen, King
 
 class WhitePawn(Pawn):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9817;"
 
 class BlackPawn(Pawn):
-    def __init__(self):
-        super().__init__(2)
+    __slots__ = ()
+    player = 2
     symbol = "&#9823;"
 
 class WhiteKnight(Knight):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9816;"
     
 class BlackKnight(Knight):
-    def __init__(self):
-        super().__init__(2)
+    __slots__ = ()
+    player = 2
     symbol = "&#9822;"
 
 class WhiteBishop(Bishop):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9815;"
 
 class BlackBishop(Bishop):
-    def __init__(self):
-        super().__init__(2)
+    __slots__ = ()
+    player = 2
     symbol = "&#9821;"
 
 class WhiteRook(Rook):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9814;"
 
 class BlackRook(Rook):
-    def __init__(self):
-        super().__init__(2)
+    __slots__ = ()
+    player = 2
     symbol = "&#9820;"
 
 class WhiteQueen(Queen):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9813;"
 
 class BlackQueen(Queen):
-    def __init__(self):
-        super().__init__(2)
+    __slots__ = ()
+    player = 2
     symbol = "&#9819;"
 
 class WhiteKing(King):
-    def __init__(self):
-        super().__init__(1)
+    __slots__ = ()
+    player = 1
     symbol = "&#9812;"
 
 class BlackKing(King):
-    def __init__(self):
-        super().__init__(2)
-    symbol = "&#9818;"
\ No newline at end of file
+    __slots__ = ()
+    player = 2
+    symbol = "&#9818;"
+
+# Look up the shared instance of a piece by name and player
+PIECES = {
+    ("pawn", 1): WhitePawn(), ("pawn", 2): BlackPawn(),
+    ("knight", 1): WhiteKnight(), ("knight", 2): BlackKnight(),
+    ("bishop", 1): WhiteBishop(), ("bishop", 2): BlackBishop(),
+    ("rook", 1): WhiteRook(), ("rook", 2): BlackRook(),
+    ("queen", 1): WhiteQueen(), ("queen", 2): BlackQueen(),
+    ("king", 1): WhiteKing(), ("king", 2): BlackKing(),
+}
+
+# The same instances by their FEN letter, i.e.: "K" for the white king
+PIECES_BY_LETTER = {
+    piece.letter.upper() if piece.player == 1 else piece.letter: piece for piece in PIECES.values()
+}
+
+# ...and the other way round
+LETTERS_BY_PIECE = {piece: letter for letter, piece in PIECES_BY_LETTER.items()}
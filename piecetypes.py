@@ -9,43 +9,55 @@
 
 from abc import ABC
 
+# Names of every kind of piece, as used by Piece.name
+PIECE_NAMES = ("pawn", "knight", "bishop", "rook", "queen", "king")
+
 
 # Abstract class to model chess pieces by providing necessary attributes
+# Pieces carry no state of their own (castling rights, en passant and king
+# squares are kept by the board), so there is exactly one immutable instance
+# of each kind of piece: WhitePawn() always returns the same shared object
 class Piece(ABC):
+    __slots__ = ()
     piecetype: ABC
     player: int # side (white = 1, black = 2)
     name: str  # name of piece, i.e.: 'king'
     symbol: str  # shorthand of piece for display on board
+    letter: str  # letter for the piece in FEN (a capital for white), i.e.: 'k'
     value: int  # algebraic value (not used)
     player: int  # belongs to player 1 or 2
     moves: frozenset  # all the legal moves for the piece, as vectors
     scalable: bool  # can piece move freely along a given path (i.e.: queen)?
     # does this piece have moves outside of the norm (i.e.: castling)
     specialMoves: bool
-    # monitor if the piece has moved at all (for castling only)
-    moved: bool = False
 
-    # start with player number
-    def __init__(self, thisPlayer: int):
-        self.player: int = thisPlayer
+    # hand back the one shared instance of this kind of piece
+    def __new__(cls):
+        instance = cls.__dict__.get("instance")
+        if instance is None:
+            instance = super().__new__(cls)
+            cls.instance = instance
+        return instance
 
 
 # Pawn class (note that all pawn moves are atypical, to a strange
 # degree, so no 'typical' moves are listed)
 class Pawn(Piece):
+    __slots__ = ()
     name = "pawn"
+    letter = "p"
     symbol = "p"
     value = 1
     moves = None  # all pawn movements are affected by surrounding pieces
     scalable = False
     specialMoves = frozenset([(1, 0), (1, 1), (1, -1), (2, 0)])
-    # Identify if you had just moved two spaces for "en passant" capture
-    enPassant = False
 
 
 # Knight class
 class Knight(Piece):
+    __slots__ = ()
     name = "knight"
+    letter = "n"
     symbol = "N"
     value = 3
     moves = frozenset([(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (-1, 2),
@@ -56,7 +68,9 @@ class Knight(Piece):
 
 # Bishop class
 class Bishop(Piece):
+    __slots__ = ()
     name = "bishop"
+    letter = "b"
     symbol = "B"
     value = 3
     moves = frozenset([(1, 1), (1, -1), (-1, -1), (-1, 1)])
@@ -67,7 +81,9 @@ class Bishop(Piece):
 # Rook class (note that it is not marked as special because it can't
 # initiate castling, only follows it)
 class Rook(Piece):
+    __slots__ = ()
     name = "rook"
+    letter = "r"
     symbol = "R"
     value = 5
     moves = frozenset([(1, 0), (-1, 0), (0, 1), (0, -1)])
@@ -77,7 +93,9 @@ class Rook(Piece):
 
 # Queen class
 class Queen(Piece):
+    __slots__ = ()
     name = "queen"
+    letter = "q"
     symbol = "Q"
     value = 9
     moves = frozenset([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1),
@@ -88,11 +106,12 @@ class Queen(Piece):
 
 # King class
 class King(Piece):
+    __slots__ = ()
     name = "king"
+    letter = "k"
     symbol = "K"
     value = None
     moves = frozenset([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1),
                        (-1, -1), (-1, 1)])
     scalable = False
     specialMoves = frozenset([(0, -2), (0, 2)])
-    location: None
@@ -0,0 +1,113 @@
+import threading
+from contextlib import contextmanager
+
+from game_store import VersionWaiter
+
+# The in-memory backend for game_store (GAME_STORE=memory).  Games only live
+# as long as the process and are not shared with other workers, so this is
+# for tests and for benchmarking the app without a database behind it
+
+_games = {}  # game code -> {"state", "version", "snapshot_ply", "position_version", "status"}
+_moves = {}  # game code -> {ply: (from square, to square, promotion)}
+_lock = threading.Lock()
+_waiter = VersionWaiter()
+
+
+# What a transaction has changed, so it can be put back if the transaction
+# fails, and the saves to announce once it has not
+class _Transaction:
+
+    def __init__(self):
+        self.undo = {}  # game code -> (game, moves) as they were before
+        self.saved = []  # (game code, version)
+
+    # Rows are replaced rather than changed in place, so keeping the old ones
+    # is enough to undo
+    def touch(self, game_code: int):
+        if game_code not in self.undo:
+            self.undo[game_code] = (_games.get(game_code), _moves.get(game_code))
+
+
+# One transaction at a time, which is as isolated as they come
+@contextmanager
+def transaction(write: bool = True):
+    with _lock:
+        handle = _Transaction()
+        try:
+            yield handle
+        except BaseException:
+            for game_code, (game, moves) in handle.undo.items():
+                for table, row in ((_games, game), (_moves, moves)):
+                    if row is None:
+                        table.pop(game_code, None)
+                    else:
+                        table[game_code] = row
+            raise
+    for game_code, version in handle.saved:
+        _waiter.heard(game_code, version)
+
+
+# Nothing to set up
+def migrate() -> int:
+    return 0
+
+
+def insert_game(handle, game_code: int, state: dict, snapshot_ply: int, status) -> bool:
+    if game_code in _games:
+        return False
+    handle.touch(game_code)
+    _games[game_code] = {"state": state, "version": 0, "snapshot_ply": snapshot_ply, "position_version": 0,
+                         "status": status}
+    _moves[game_code] = {}
+    return True
+
+
+def read_game(handle, game_code: int, cached_version) -> tuple:
+    game = _games.get(game_code)
+    if game is None:
+        return None
+    if game["version"] == cached_version:
+        return None, game["version"], None, game["position_version"], None
+    moves = _moves[game_code]
+    return (
+        game["state"],
+        game["version"],
+        [list(moves[ply]) for ply in sorted(moves) if ply > game["snapshot_ply"]],
+        game["position_version"],
+        game["status"],
+    )
+
+
+def write_game(handle, game_code: int, version: int, state, snapshot_ply: int, moved: bool, moves: list,
+               status):
+    game = _games.get(game_code)
+    if game is None or game["version"] != version:
+        return None
+    handle.touch(game_code)
+    game = _games[game_code] = dict(game, version=version + 1, status=status)
+    if state is not None:
+        game["state"] = state
+        game["snapshot_ply"] = snapshot_ply
+    if moved:
+        game["position_version"] = game["version"]
+    logged = _moves[game_code] = dict(_moves[game_code])
+    for ply, start, end, promotion in moves:
+        if ply in logged:
+            raise ValueError(f"Move {ply} of game {game_code} has already been saved")
+        logged[ply] = (start, end, promotion)
+    handle.saved.append((game_code, game["version"]))
+    return game["version"]
+
+
+def read_moves(handle, game_code: int) -> list:
+    moves = _moves.get(game_code, {})
+    return [(ply,) + moves[ply] for ply in sorted(moves)]
+
+
+def read_version(handle, game_code: int):
+    game = _games.get(game_code)
+    return game["version"] if game is not None else None
+
+
+def wait_for_version(game_code: int, since: int, timeout: float) -> int:
+    return _waiter.wait(game_code, since, timeout)
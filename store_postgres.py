@@ -0,0 +1,356 @@
+import atexit
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
+
+from game_store import GameStoreError, VersionWaiter
+
+# The PostgreSQL backend for game_store (GAME_STORE=postgres, the default),
+# connecting to DATABASE_URL
+
+# Schema changes, applied in order and recorded in chess_schema_migrations so
+# each one runs exactly once per database.  Add new steps to the end and never
+# edit one that has already been released
+MIGRATIONS = (
+    (1, """
+    CREATE TABLE IF NOT EXISTS chess_games (
+        game_code INTEGER PRIMARY KEY,
+        state JSONB NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """),
+    # One row per move, with chess_games.state only rewritten every so often
+    (2, """
+    ALTER TABLE chess_games ADD COLUMN snapshot_ply INTEGER NOT NULL DEFAULT 0;
+    CREATE TABLE chess_moves (
+        game_code INTEGER NOT NULL REFERENCES chess_games (game_code) ON DELETE CASCADE,
+        ply INTEGER NOT NULL,
+        from_square SMALLINT NOT NULL,
+        to_square SMALLINT NOT NULL,
+        promotion TEXT,
+        version INTEGER NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (game_code, ply)
+    )
+    """),
+    # Version at which a move was last made, so a write that only changed the
+    # game's details can be told apart from an opponent's move
+    (3, """
+    ALTER TABLE chess_games ADD COLUMN position_version INTEGER NOT NULL DEFAULT 0;
+    UPDATE chess_games SET position_version = version
+    """),
+    # Check, checkmate, stalemate and legal moves after the latest move
+    (4, """
+    ALTER TABLE chess_games ADD COLUMN status JSONB
+    """),
+)
+
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS chess_schema_migrations (
+    version INTEGER PRIMARY KEY,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+)
+"""
+
+# Advisory lock key held while migrating, so workers starting together do not
+# apply the same step twice
+MIGRATIONS_LOCK = 0x43686573
+
+
+# One pool per process, opened on first use.  A forked worker must not share
+# the sockets it inherited from its parent, so the pool remembers which
+# process opened it and a child simply starts a pool of its own
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _database_url() -> str:
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise GameStoreError("DATABASE_URL must be configured")
+    return database_url
+
+
+def _pool_setting(name, default, kind=int):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise GameStoreError(f"{name} must be a number")
+
+
+def _get_pool() -> ConnectionPool:
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            pool = ConnectionPool(
+                _database_url(),
+                min_size=_pool_setting("DATABASE_POOL_MIN_SIZE", 1),
+                max_size=_pool_setting("DATABASE_POOL_MAX_SIZE", 10),
+                max_idle=_pool_setting("DATABASE_POOL_MAX_IDLE", 300.0, float),
+                timeout=_pool_setting("DATABASE_POOL_TIMEOUT", 30.0, float),
+                check=ConnectionPool.check_connection,
+                name="chess_games",
+                open=True,
+            )
+            if _pool_setting("DATABASE_AUTO_MIGRATE", 1):
+                try:
+                    with pool.connection() as connection:
+                        _migrate(connection)
+                except Exception:
+                    pool.close()
+                    raise
+            _pool = pool
+            _pool_pid = pid
+    return _pool
+
+
+def close_pool() -> None:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+        _pool_pid = None
+
+
+def _forget_inherited_pool() -> None:
+    global _pool, _pool_pid, _pool_lock, _listener, _listener_pid
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+    _listener = None
+    _listener_pid = None
+
+
+atexit.register(close_pool)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_pool)
+
+
+# Borrow a connection from the pool for one transaction, which is committed
+# (or rolled back on an error) when the block ends.  Reads and writes are
+# handled alike, so write is only there to match the other backends
+@contextmanager
+def transaction(write: bool = True):
+    with _get_pool().connection() as connection:
+        with connection.cursor() as cursor:
+            yield cursor
+
+
+# Bring the schema up to date inside the connection's transaction, returning
+# the version it ends up at
+def _migrate(connection) -> int:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK,))
+        cursor.execute(MIGRATIONS_TABLE)
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM chess_schema_migrations")
+        current = cursor.fetchone()[0]
+        for version, statement in MIGRATIONS:
+            if version > current:
+                cursor.execute(statement)
+                cursor.execute("INSERT INTO chess_schema_migrations (version) VALUES (%s)", (version,))
+                current = version
+    return current
+
+
+def migrate() -> int:
+    with _get_pool().connection() as connection:
+        return _migrate(connection)
+
+
+def insert_game(cursor, game_code: int, state: dict, snapshot_ply: int, status) -> bool:
+    cursor.execute(
+        """
+        INSERT INTO chess_games (game_code, state, snapshot_ply, status) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (game_code) DO NOTHING
+        RETURNING game_code
+        """,
+        (game_code, Jsonb(state), snapshot_ply, Jsonb(status)),
+    )
+    return cursor.fetchone() is not None
+
+
+# The last full state of a game, its version, the moves logged after the
+# state was saved (as [from, to, promotion]), the version of the last move and
+# the status after it.  Everything but the versions is only sent when the
+# version differs from the given (cached) one
+LOAD_QUERY = """
+SELECT
+    CASE WHEN version = %(cached_version)s THEN NULL ELSE state END,
+    version,
+    CASE WHEN version = %(cached_version)s THEN NULL ELSE (
+        SELECT json_agg(json_build_array(from_square, to_square, promotion) ORDER BY ply)
+        FROM chess_moves
+        WHERE chess_moves.game_code = chess_games.game_code AND ply > chess_games.snapshot_ply
+    ) END,
+    position_version,
+    CASE WHEN version = %(cached_version)s THEN NULL ELSE status END
+FROM chess_games WHERE game_code = %(game_code)s
+"""
+
+
+def read_game(cursor, game_code: int, cached_version) -> tuple:
+    cursor.execute(LOAD_QUERY, {"cached_version": cached_version, "game_code": game_code})
+    return cursor.fetchone()
+
+
+def write_game(cursor, game_code: int, version: int, state, snapshot_ply: int, moved: bool, moves: list,
+               status):
+    if state is not None:
+        cursor.execute(
+            """
+            UPDATE chess_games
+            SET state = %s, snapshot_ply = %s, status = %s, version = version + 1,
+                position_version = CASE WHEN %s THEN version + 1 ELSE position_version END,
+                updated_at = NOW()
+            WHERE game_code = %s AND version = %s
+            RETURNING version
+            """,
+            (Jsonb(state), snapshot_ply, Jsonb(status), moved, game_code, version),
+        )
+    else:
+        cursor.execute(
+            """
+            UPDATE chess_games
+            SET status = %s, version = version + 1,
+                position_version = CASE WHEN %s THEN version + 1 ELSE position_version END,
+                updated_at = NOW()
+            WHERE game_code = %s AND version = %s
+            RETURNING version
+            """,
+            (Jsonb(status), moved, game_code, version),
+        )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    if moves:
+        cursor.executemany(
+            """
+            INSERT INTO chess_moves (game_code, ply, from_square, to_square, promotion, version)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """,
+            [(game_code, ply, start, end, promotion, row[0]) for ply, start, end, promotion in moves],
+        )
+    # Delivered to listeners on every worker once this commits
+    cursor.execute(
+        "SELECT pg_notify(%s, %s)",
+        (NOTIFY_CHANNEL, f"{game_code}:{row[0]}"),
+    )
+    return row[0]
+
+
+def read_moves(cursor, game_code: int) -> list:
+    cursor.execute(
+        """
+        SELECT ply, from_square, to_square, promotion FROM chess_moves
+        WHERE game_code = %s ORDER BY ply
+        """,
+        (game_code,),
+    )
+    return cursor.fetchall()
+
+
+def read_version(cursor, game_code: int):
+    cursor.execute(
+        "SELECT version FROM chess_games WHERE game_code = %s",
+        (game_code,),
+    )
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+# Saves are announced on this channel as "<game code>:<new version>"
+NOTIFY_CHANNEL = "chess_games"
+
+
+# Longest a request waits for the listener to connect before looking the
+# version up itself, and how often requests look it up while the listener is
+# not connected and while it is (in case a notification never arrives, i.e.:
+# behind a proxy that pools transactions, or on a connection that has quietly
+# died), in seconds
+LISTEN_CONNECT_TIMEOUT = 2.0
+LISTEN_POLL_INTERVAL = 1.0
+LISTEN_RECHECK_INTERVAL = 5.0
+
+
+# Holds one connection per process that LISTENs for saves, and wakes up the
+# requests waiting on the games that were saved.  Saves made while it is not
+# listening (before it first connects, or while it reconnects) go unheard, so
+# waiting requests poll more often until it is, and it looks up the versions
+# of the games being waited on each time it starts listening
+class _VersionListener(VersionWaiter):
+
+    def __init__(self, database_url: str):
+        super().__init__()
+        self.database_url = database_url
+        self.listening = threading.Event()
+        threading.Thread(target=self.listen, name="chess_games listener", daemon=True).start()
+
+    def poll_interval(self):
+        return LISTEN_RECHECK_INTERVAL if self.listening.is_set() else LISTEN_POLL_INTERVAL
+
+    def wait(self, game_code: int, since: int, timeout: float) -> int:
+        self.listening.wait(min(timeout, LISTEN_CONNECT_TIMEOUT))
+        return super().wait(game_code, since, timeout)
+
+    def listen(self):
+        while True:
+            try:
+                with psycopg.connect(self.database_url, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    self.catch_up(connection)
+                    self.listening.set()
+                    for notify in connection.notifies():
+                        try:
+                            game_code, version = (int(part) for part in notify.payload.split(":"))
+                        except ValueError:
+                            continue
+                        self.heard(game_code, version)
+            except Exception as error:
+                # Anything going wrong must not end the thread, or the process
+                # would never hear about a save again.  Waiting requests poll
+                # for the version more often until it reconnects
+                self.listening.clear()
+                print(f"lost the {NOTIFY_CHANNEL} listener connection: {error!r}")
+                time.sleep(1)
+
+    # Announce the versions of the games being waited on, in case they were
+    # saved while nothing was listening
+    def catch_up(self, connection):
+        with self.condition:
+            game_codes = list(self.waiting)
+        if game_codes:
+            rows = connection.execute(
+                "SELECT game_code, version FROM chess_games WHERE game_code = ANY(%s)",
+                (game_codes,),
+            ).fetchall()
+            for game_code, version in rows:
+                self.heard(game_code, version)
+
+
+_listener = None
+_listener_pid = None
+
+
+def wait_for_version(game_code: int, since: int, timeout: float) -> int:
+    global _listener, _listener_pid
+    pid = os.getpid()
+    with _pool_lock:
+        if _listener is None or _listener_pid != pid:
+            _listener = _VersionListener(_database_url())
+            _listener_pid = pid
+    return _listener.wait(game_code, since, timeout)
@@ -0,0 +1,245 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from game_store import VersionWaiter
+
+# The SQLite backend for game_store (GAME_STORE=sqlite), keeping every game in
+# one file at SQLITE_PATH.  The file is opened in WAL mode, so pages can be
+# read while a move is being saved, but every worker has to be on the same
+# machine as the file
+
+# Schema changes, applied in order, with the last one applied kept in the
+# file's user_version.  Add new steps to the end and never edit one that has
+# already been released
+MIGRATIONS = (
+    (1, (
+        """
+        CREATE TABLE chess_games (
+            game_code INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            snapshot_ply INTEGER NOT NULL DEFAULT 0,
+            position_version INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE chess_moves (
+            game_code INTEGER NOT NULL REFERENCES chess_games (game_code) ON DELETE CASCADE,
+            ply INTEGER NOT NULL,
+            from_square INTEGER NOT NULL,
+            to_square INTEGER NOT NULL,
+            promotion TEXT,
+            version INTEGER NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (game_code, ply)
+        )
+        """,
+    )),
+    # Check, checkmate, stalemate and legal moves after the latest move
+    (2, (
+        "ALTER TABLE chess_games ADD COLUMN status TEXT",
+    )),
+)
+
+# Saves made by other processes are not announced, so requests waiting on a
+# game also look its version up this often (in seconds)
+POLL_INTERVAL = 1.0
+
+# Seconds to wait for another connection to finish writing
+BUSY_TIMEOUT = 30.0
+
+# One connection per thread, since a connection cannot be shared between them,
+# and opened again in a forked worker rather than inherited.  The schema is
+# only brought up to date by the first of them in each process
+_local = threading.local()
+_migrated_pid = None
+_migrate_lock = threading.Lock()
+_waiter = None
+_waiter_pid = None
+_waiter_lock = threading.Lock()
+
+
+def _path() -> str:
+    return os.environ.get("SQLITE_PATH") or "chess_games.sqlite3"
+
+
+def _connection() -> sqlite3.Connection:
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        # Transactions are begun and ended by hand in transaction()
+        connection = sqlite3.connect(_path(), timeout=BUSY_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        if os.environ.get("DATABASE_AUTO_MIGRATE", "1") != "0":
+            _migrate_once(connection)
+        _local.connection = connection
+        _local.pid = pid
+    return _local.connection
+
+
+def _get_waiter() -> VersionWaiter:
+    global _waiter, _waiter_pid
+    pid = os.getpid()
+    with _waiter_lock:
+        if _waiter is None or _waiter_pid != pid:
+            _waiter = VersionWaiter(POLL_INTERVAL)
+            _waiter_pid = pid
+    return _waiter
+
+
+# The connection a transaction is on, and the saves to announce once it has
+# been committed
+class _Transaction:
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.saved = []  # (game code, version)
+
+
+# Writers take the file's write lock from the start, so two of them cannot
+# both read a game and then find they are unable to save it
+@contextmanager
+def transaction(write: bool = True):
+    connection = _connection()
+    connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    handle = _Transaction(connection)
+    try:
+        yield handle
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    for game_code, version in handle.saved:
+        _get_waiter().heard(game_code, version)
+
+
+def _migrate(connection: sqlite3.Connection) -> int:
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        current = connection.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in MIGRATIONS:
+            if version > current:
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f"PRAGMA user_version = {version:d}")
+                current = version
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return current
+
+
+def _migrate_once(connection: sqlite3.Connection):
+    global _migrated_pid
+    pid = os.getpid()
+    if _migrated_pid == pid:
+        return
+    with _migrate_lock:
+        if _migrated_pid != pid:
+            _migrate(connection)
+            _migrated_pid = pid
+
+
+def migrate() -> int:
+    return _migrate(_connection())
+
+
+def insert_game(handle, game_code: int, state: dict, snapshot_ply: int, status) -> bool:
+    cursor = handle.connection.execute(
+        "INSERT OR IGNORE INTO chess_games (game_code, state, snapshot_ply, status) VALUES (?, ?, ?, ?)",
+        (game_code, json.dumps(state), snapshot_ply, json.dumps(status)),
+    )
+    return cursor.rowcount == 1
+
+
+def read_game(handle, game_code: int, cached_version) -> tuple:
+    connection = handle.connection
+    row = connection.execute(
+        "SELECT version, snapshot_ply, position_version FROM chess_games WHERE game_code = ?",
+        (game_code,),
+    ).fetchone()
+    if row is None:
+        return None
+    version, snapshot_ply, position_version = row
+    if version == cached_version:
+        return None, version, None, position_version, None
+    state, status = connection.execute(
+        "SELECT state, status FROM chess_games WHERE game_code = ?",
+        (game_code,),
+    ).fetchone()
+    moves = connection.execute(
+        """
+        SELECT from_square, to_square, promotion FROM chess_moves
+        WHERE game_code = ? AND ply > ? ORDER BY ply
+        """,
+        (game_code, snapshot_ply),
+    ).fetchall()
+    return state, version, [list(move) for move in moves], position_version, status
+
+
+def write_game(handle, game_code: int, version: int, state, snapshot_ply: int, moved: bool, moves: list,
+               status):
+    connection = handle.connection
+    if state is not None:
+        cursor = connection.execute(
+            """
+            UPDATE chess_games
+            SET state = ?, snapshot_ply = ?, status = ?, version = version + 1,
+                position_version = CASE WHEN ? THEN version + 1 ELSE position_version END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE game_code = ? AND version = ?
+            """,
+            (json.dumps(state), snapshot_ply, json.dumps(status), moved, game_code, version),
+        )
+    else:
+        cursor = connection.execute(
+            """
+            UPDATE chess_games
+            SET status = ?, version = version + 1,
+                position_version = CASE WHEN ? THEN version + 1 ELSE position_version END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE game_code = ? AND version = ?
+            """,
+            (json.dumps(status), moved, game_code, version),
+        )
+    if cursor.rowcount != 1:
+        return None
+    if moves:
+        connection.executemany(
+            """
+            INSERT INTO chess_moves (game_code, ply, from_square, to_square, promotion, version)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [(game_code, ply, start, end, promotion, version + 1) for ply, start, end, promotion in moves],
+        )
+    handle.saved.append((game_code, version + 1))
+    return version + 1
+
+
+def read_moves(handle, game_code: int) -> list:
+    return handle.connection.execute(
+        """
+        SELECT ply, from_square, to_square, promotion FROM chess_moves
+        WHERE game_code = ? ORDER BY ply
+        """,
+        (game_code,),
+    ).fetchall()
+
+
+def read_version(handle, game_code: int):
+    row = handle.connection.execute(
+        "SELECT version FROM chess_games WHERE game_code = ?",
+        (game_code,),
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
+def wait_for_version(game_code: int, since: int, timeout: float) -> int:
+    return _get_waiter().wait(game_code, since, timeout)
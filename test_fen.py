@@ -0,0 +1,69 @@
+# FEN import and export (Chess.fromFEN and Chess.toFEN)
+
+import pytest
+
+from chess import Chess
+from perft import POSITIONS
+
+
+@pytest.mark.parametrize("name", sorted(POSITIONS))
+def test_round_trip(name):
+    fen = POSITIONS[name][0]
+    assert Chess.fromFEN(fen).toFEN() == fen
+
+
+def test_counters_default():
+    chess = Chess.fromFEN("4k3/8/8/8/8/8/8/4K3 b - -")
+    assert chess.toFEN() == "4k3/8/8/8/8/8/8/4K3 b - - 0 1"
+
+
+def test_castling_without_king_and_rook_is_dropped():
+    chess = Chess.fromFEN("4k3/8/8/8/8/8/8/6KR w K - 0 1")
+    assert chess.toFEN() == "4k3/8/8/8/8/8/8/6KR w - - 0 1"
+    assert "g1a2" not in {str(move) for move in chess.board.generate_legal_moves(1)}
+
+
+def test_castling_keeps_rights_the_pieces_allow():
+    chess = Chess.fromFEN("r3k3/8/8/8/8/8/8/R3K2R w KQkq - 0 1")
+    assert chess.toFEN() == "r3k3/8/8/8/8/8/8/R3K2R w KQq - 0 1"
+    moves = {str(move) for move in chess.board.generate_legal_moves(1)}
+    assert {"e1g1", "e1c1"} <= moves
+
+
+def test_en_passant():
+    chess = Chess.fromFEN("rnbqkbnr/ppp1pppp/8/8/3pP3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 3")
+    assert "d4e3" in {str(move) for move in chess.board.generate_legal_moves(2)}
+
+
+@pytest.mark.parametrize("fen", [
+    "4k3/8/8/8/8/8/3P4/4K3 w - e3",  # wrong rank for the side to move
+    "4k3/8/8/8/8/8/8/4K3 b - e3",  # no pawn went past it
+    "4k3/8/8/8/4p3/8/8/4K3 w - e6",  # a white pawn's square, with white to move
+    "4k3/8/8/4p3/8/8/8/4K3 b - e3",
+    "4k3/8/8/8/8/8/8/4K3 w - e9",
+])
+def test_bad_en_passant(fen):
+    with pytest.raises(ValueError):
+        Chess.fromFEN(fen)
+
+
+@pytest.mark.parametrize("fen", [
+    "8/8/8/8/8/8/8/8 w - -",
+    "4k3/8/8/8/8/8/8/8 w - -",
+    "4k3/8/8/8/8/8/8/3KK3 w - -",
+])
+def test_one_king_each(fen):
+    with pytest.raises(ValueError):
+        Chess.fromFEN(fen)
+
+
+@pytest.mark.parametrize("fen", [
+    "4k3/8/8/8/8/8/8/4K3 x - -",
+    "4k3/8/8/8/8/8/8/4K3 w X -",
+    "4k3/8/8/8/8/8/4K3 w - -",
+    "4k3/8/8/8/8/8/8/4K3 w - - a 1",
+    "4k3/8/8/8/8/8/8/4K3",
+])
+def test_malformed(fen):
+    with pytest.raises(ValueError):
+        Chess.fromFEN(fen)
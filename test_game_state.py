@@ -0,0 +1,117 @@
+# Loading games saved in each of the formats game.py has written (see
+# Game.from_state), so old saves keep working
+
+import pytest
+
+from game import STATE_FORMAT, Game
+
+CODES = {"game_code": 123456, "player_1_code": 1111222233334444, "player_2_code": 5555666677778888,
+         "host_player": 1, "guest_code_claimed": True}
+
+
+# Format 1 kept an 8x8 list of pieces from rank 1 up, each with a "moved" flag
+# (and an "en_passant" flag on pawns).  Rows are given here from rank 8 down,
+# as in FEN, with "." for an empty square and "*" after a piece that has moved
+def format1_board(rows: list) -> list:
+    names = {"p": "pawn", "n": "knight", "b": "bishop", "r": "rook", "q": "queen", "k": "king"}
+    board = []
+    for text in reversed(rows):
+        row = []
+        for letter, flag in zip(text[0::2], text[1::2]):
+            if letter == ".":
+                row.append(None)
+                continue
+            piece = {"type": names[letter.lower()], "player": 1 if letter.isupper() else 2, "moved": flag in "*e"}
+            if piece["type"] == "pawn":
+                piece["en_passant"] = flag == "e"
+            row.append(piece)
+        board.append(row)
+    return board
+
+
+FORMAT_1 = dict(CODES, current_player=2, game_on=True, pending_promotion=None, board=format1_board([
+    "r n b q k b n r ",
+    "p p p p p p p p ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    ". . . . Pe. . . ",
+    ". . . . . . . . ",
+    "P P P P . P P P ",
+    "R N B Q K B N R ",
+]))
+
+FORMAT_1_PROMOTION = dict(CODES, current_player=1, game_on=True, pending_promotion=[7, 0], board=format1_board([
+    "P*. . . k*. . r ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    ". . . . . . . . ",
+    "R . . . K*. . . ",
+]))
+
+# Format 2 kept the position in FEN, at first without the move counters, and
+# a pawn waiting to be promoted as the square it reached
+FORMAT_2 = dict(CODES, format=2, game_on=True, pending_promotion=None,
+                position="rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2")
+
+FORMAT_2_PROMOTION = dict(CODES, format=2, game_on=True, pending_promotion="a8",
+                          position="P3k2r/8/8/8/8/8/8/R3K3 w k -")
+
+# Format 3 keeps the position from before a pawn waiting to be promoted moved,
+# with its move, and the number of plies played
+FORMAT_3_PROMOTION = dict(CODES, format=3, game_on=True, pending_promotion="a7a8", ply=77,
+                          position="4k2r/P7/8/8/8/8/8/R3K3 w k - 0 39")
+
+
+def test_format_1():
+    game = Game.from_state(FORMAT_1, 5)
+    assert game.version == 5
+    assert (game.gamecode, game.player1code, game.player2code, game.hostPlayer, game.guestCodeClaimed) == \
+        tuple(CODES.values())
+    assert game.chess_game.toFEN() == "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1"
+    assert not game.awaiting_promotion()
+
+
+def test_format_2():
+    game = Game.from_state(FORMAT_2, 0)
+    assert game.chess_game.toFEN() == FORMAT_2["position"]
+    assert not game.awaiting_promotion()
+
+
+# Each promotion loads with the pawn on the far side, still waiting for its
+# piece, and becomes a queen once the player picks one
+@pytest.mark.parametrize("state, ply", [(FORMAT_1_PROMOTION, 0), (FORMAT_2_PROMOTION, 0), (FORMAT_3_PROMOTION, 77)])
+def test_pending_promotion(state, ply):
+    game = Game.from_state(state, 3)
+    assert game.awaiting_promotion()
+    assert game.chess_game.currentPlayer == 1
+    assert game.chess_game.board.placement().startswith("P3k2r/8/")
+    assert game.ply() == ply
+    should_save, view = game.take_turn(CODES["player_1_code"], {"promotion": "1", "promotion_pieces": "1"})
+    assert should_save and view["error"] == ""
+    assert game.chess_game.board.placement().startswith("Q3k2r/8/")
+    assert game.chess_game.currentPlayer == 2
+
+
+def test_format_3_promotion_is_logged_as_a_move():
+    game = Game.from_state(FORMAT_3_PROMOTION, 3)
+    assert game.to_state()["pending_promotion"] == "a7a8"
+    game.take_turn(CODES["player_1_code"], {"promotion": "1", "promotion_pieces": "1"})
+    assert [(ply, str(move)) for ply, move in game.unsaved_moves()] == [(78, "a7a8q")]
+
+
+@pytest.mark.parametrize("state", [FORMAT_1, FORMAT_1_PROMOTION, FORMAT_2, FORMAT_2_PROMOTION, FORMAT_3_PROMOTION])
+def test_saves_in_current_format(state):
+    game = Game.from_state(state, 0)
+    saved = game.to_state()
+    assert saved["format"] == STATE_FORMAT
+    again = Game.from_state(saved, 0)
+    assert again.chess_game.toFEN() == game.chess_game.toFEN()
+    assert again.awaiting_promotion() == game.awaiting_promotion()
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        Game.from_state(dict(FORMAT_2, format=99), 0)
@@ -0,0 +1,237 @@
+# Saving and loading games through game_store, on the in-memory and SQLite
+# backends (PostgreSQL needs a server, so it is left to a real deployment)
+
+import json
+import threading
+
+import pytest
+
+import game_store
+import store_memory
+import store_sqlite
+from game import Game
+from lru import LRUCache
+
+# Castling, captures and some quiet moves, 14 plies in all
+OPENING = [("e2", "e4"), ("e7", "e5"), ("g1", "f3"), ("b8", "c6"), ("f1", "c4"), ("g8", "f6"),
+           ("d2", "d3"), ("f8", "c5"), ("e1", "g1"), ("d7", "d6"), ("c1", "g5"), ("h7", "h6"),
+           ("g5", "f6"), ("d8", "f6")]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, monkeypatch, tmp_path):
+    monkeypatch.setenv("GAME_STORE", request.param)
+    monkeypatch.setenv("SQLITE_PATH", str(tmp_path / "games.sqlite3"))
+    monkeypatch.setattr(game_store, "_store", None)
+    monkeypatch.setattr(game_store, "SNAPSHOT_INTERVAL", 4)
+    monkeypatch.setattr(game_store, "_game_cache", LRUCache(16))
+    monkeypatch.setattr(store_memory, "_games", {})
+    monkeypatch.setattr(store_memory, "_moves", {})
+    monkeypatch.setattr(store_sqlite, "_local", threading.local())
+    monkeypatch.setattr(store_sqlite, "_migrated_pid", None)
+    return game_store._get_store()
+
+
+def new_game() -> Game:
+    game = Game(None)
+    game.setHostPlayer(1)
+    assert game_store.create_game(game)
+    return game
+
+
+# Play a move for whoever's turn it is, as the page's form would
+def play(game: Game, start: str, end: str):
+    should_save, view = game.take_turn(game.getPlayerCode(game.chess_game.currentPlayer),
+                                       {"next_move_start": start, "next_move_end": end})
+    assert view["error"] == ""
+    return should_save, view
+
+
+# The game as a fresh process would load it, without the cached copy
+def reload(game_code: int) -> Game:
+    game_store._game_cache = LRUCache(16)
+    return game_store.load_game(game_code)
+
+
+def saved_row(store, game_code: int) -> tuple:
+    with store.transaction(write=False) as handle:
+        state, version, moves, position_version, status = store.read_game(handle, game_code, None)
+    if isinstance(state, str):
+        state = json.loads(state)
+    return state, version, moves, position_version
+
+
+def test_round_trip_across_snapshots(store):
+    game = new_game()
+    for ply, (start, end) in enumerate(OPENING, 1):
+        play(game, start, end)
+        game_store.save_game(game)
+        loaded = reload(game.gamecode)
+        assert loaded.version == game.version == ply
+        assert loaded.chess_game.toFEN() == game.chess_game.toFEN()
+        assert loaded.to_state() == game.to_state()
+    assert [str(move) for ply, move in game_store.load_moves(game.gamecode)] == \
+        [start + end for start, end in OPENING]
+
+
+def test_load_replays_moves_since_snapshot(store):
+    game = new_game()
+    for start, end in OPENING[:6]:
+        play(game, start, end)
+        game_store.save_game(game)
+    state, version, moves, position_version = saved_row(store, game.gamecode)
+    assert state["ply"] == 4
+    assert [list(move)[:2] for move in moves] == [[5, 26], [62, 45]]  # f1c4 and g8f6
+    loaded = reload(game.gamecode)
+    assert loaded.chess_game.toFEN() == game.chess_game.toFEN()
+    # Playing on from the loaded game logs the next move after the replayed ones
+    play(loaded, *OPENING[6])
+    game_store.save_game(loaded)
+    assert len(game_store.load_moves(game.gamecode)) == 7
+    assert reload(game.gamecode).chess_game.toFEN() == loaded.chess_game.toFEN()
+
+
+def test_detail_change_writes_snapshot(store):
+    game = new_game()
+    play(game, *OPENING[0])
+    game_store.save_game(game)
+    game.guestCodeClaimed = True
+    game_store.save_game(game)
+    state, version, moves, position_version = saved_row(store, game.gamecode)
+    assert (state["ply"], version, position_version) == (1, 2, 1)
+    assert reload(game.gamecode).guestCodeClaimed
+
+
+def test_stale_save_conflicts(store):
+    game = new_game()
+    other = reload(game.gamecode)
+    play(game, *OPENING[0])
+    game_store.save_game(game)
+    play(other, "d2", "d4")
+    with pytest.raises(game_store.GameVersionConflict):
+        game_store.save_game(other)
+    assert reload(game.gamecode).chess_game.toFEN() == game.chess_game.toFEN()
+
+
+# apply_move as the move form uses it: play for the player, saving if asked
+def move(start: str, end: str, player: int):
+    def mutate(game):
+        return game.take_turn(game.getPlayerCode(player), {"next_move_start": start, "next_move_end": end})
+    return mutate
+
+
+def test_apply_move(store):
+    game = new_game()
+    game, view = game_store.apply_move(game.gamecode, 0, move("e2", "e4", 1))
+    assert view["error"] == "" and game.version == 1
+    loaded = reload(game.gamecode)
+    assert loaded.chess_game.toFEN() == game.chess_game.toFEN()
+
+
+def test_apply_move_rejected_move_is_not_saved(store):
+    game = new_game()
+    game, view = game_store.apply_move(game.gamecode, 0, move("e2", "e5", 1))
+    assert view["error"] == "Move is illegal"
+    assert game_store.load_version(game.gamecode) == 0
+
+
+def test_apply_move_after_detail_change(store):
+    game = new_game()
+    game.guestCodeClaimed = True
+    game_store.save_game(game)
+    # The page was drawn before the guest joined, which is no reason to refuse
+    game, view = game_store.apply_move(game.gamecode, 0, move("e2", "e4", 1))
+    assert view["error"] == "" and game.version == 2
+    assert reload(game.gamecode).guestCodeClaimed
+
+
+def test_apply_move_retries_lost_race(store, monkeypatch):
+    game = new_game()
+    write_game = game_store._write_game
+    attempts = []
+
+    # The first write loses to a save that only claimed the guest's code
+    def losing_write(store, handle, game):
+        attempts.append(game.version)
+        if len(attempts) == 1:
+            game_store._game_cache.discard(game.gamecode)
+            return None
+        return write_game(store, handle, game)
+
+    monkeypatch.setattr(game_store, "_write_game", losing_write)
+    game, view = game_store.apply_move(game.gamecode, 0, move("e2", "e4", 1))
+    assert len(attempts) == 2 and view["error"] == ""
+    assert reload(game.gamecode).chess_game.toFEN() == game.chess_game.toFEN()
+
+
+def test_apply_move_gives_up_after_attempts(store, monkeypatch):
+    game = new_game()
+    monkeypatch.setattr(game_store, "_write_game", lambda store, handle, game: None)
+    with pytest.raises(game_store.GameVersionConflict):
+        game_store.apply_move(game.gamecode, 0, move("e2", "e4", 1))
+    assert game_store.load_version(game.gamecode) == 0
+
+
+def test_apply_move_conflicts_with_opponent_move(store):
+    game = new_game()
+    game_store.apply_move(game.gamecode, 0, move("e2", "e4", 1))
+    game_store.apply_move(game.gamecode, 1, move("e7", "e5", 2))
+    # White's page still shows the position before black moved
+    with pytest.raises(game_store.GameVersionConflict):
+        game_store.apply_move(game.gamecode, 0, move("d2", "d4", 1))
+    assert game_store.load_version(game.gamecode) == 2
+
+
+def test_create_and_missing_games(store):
+    game = new_game()
+    duplicate = Game(None)
+    duplicate.gamecode = game.gamecode
+    duplicate.setHostPlayer(1)
+    assert not game_store.create_game(duplicate)
+    with pytest.raises(game_store.GameNotFound):
+        game_store.load_game(game.gamecode + 1)
+    with pytest.raises(game_store.GameNotFound):
+        game_store.load_version(game.gamecode + 1)
+
+
+def test_failed_transaction_is_rolled_back(store):
+    game = new_game()
+    play(game, *OPENING[0])
+    with pytest.raises(RuntimeError):
+        with store.transaction() as handle:
+            assert game_store._write_game(store, handle, game) is not None
+            raise RuntimeError("failed after writing")
+    assert game_store.load_version(game.gamecode) == 0
+    assert game_store.load_moves(game.gamecode) == []
+
+
+def test_wait_for_version(store):
+    game = new_game()
+    assert game_store.wait_for_version(game.gamecode, 0, 0.1) == 0
+    loaded = reload(game.gamecode)
+    play(loaded, *OPENING[0])
+    saver = threading.Timer(0.1, game_store.save_game, (loaded,))
+    saver.start()
+    try:
+        assert game_store.wait_for_version(game.gamecode, 0, 10) == 1
+    finally:
+        saver.join()
+
+
+def test_sqlite_migrates_once(store, monkeypatch):
+    if store is not store_sqlite:
+        pytest.skip("SQLite only")
+    assert game_store.run_migrations() == store_sqlite.MIGRATIONS[-1][0]
+    migrations = []
+    migrate = store_sqlite._migrate
+    monkeypatch.setattr(store_sqlite, "_migrate", lambda connection: migrations.append(1) or migrate(connection))
+    game = new_game()
+    # Each thread opens a connection of its own, and finds the game saved
+    versions = []
+    threads = [threading.Thread(target=lambda: versions.append(game_store.load_version(game.gamecode)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert versions == [0] * 4 and migrations == []
@@ -0,0 +1,17 @@
+# Move generation checked against the known perft totals (run with pytest).
+# Depths 1 to 3 of every position take about a second; use perft.py for the
+# deeper counts
+
+import pytest
+
+from perft import POSITIONS, perft, setupPosition
+
+DEPTH = 3
+
+
+@pytest.mark.parametrize("name", sorted(POSITIONS))
+def test_perft(name):
+    fen, expected = POSITIONS[name]
+    for depth in range(1, min(DEPTH, len(expected)) + 1):
+        board, player = setupPosition(fen)
+        assert perft(board, player, depth) == expected[depth - 1], f"{name} at depth {depth}"
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+
+# Random keys for Zobrist hashing: a position's hash is the exclusive-or of
+# the keys for everything in it, so a move only has to flip the keys of what
+# it changed.  The generator is seeded so hashes agree between processes
+
+from random import Random
+
+from piecetypes import PIECE_NAMES
+
+_random = Random(2021)
+
+# One key per piece type, player and square
+PIECE_KEYS = {
+    player: {name: [_random.getrandbits(64) for index in range(64)] for name in PIECE_NAMES}
+    for player in (1, 2)
+}
+
+# One key for each combination of the four castling rights
+CASTLING_KEYS = [_random.getrandbits(64) for rights in range(16)]
+
+# One key per column for the en passant square
+EN_PASSANT_KEYS = [_random.getrandbits(64) for column in range(8)]
+
+# Flipped in when it is black (player 2) to move
+SIDE_KEY = _random.getrandbits(64)